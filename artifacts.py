@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Callable, Optional
+
+
+def fingerprint(inputs: Any) -> str:
+    """sha256 of the JSON form of `inputs`; objects are included via str()."""
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def model_fingerprint(llm) -> dict:
+    # Model id and generation parameters, without clients or credentials.
+    return {"type": llm._llm_type, **llm._identifying_params}
+
+
+class ArtifactStore:
+    """Per-result outputs of each pipeline stage, stored with their inputs'
+    fingerprint so that a stage is only recomputed when its inputs change.
+
+    Artifacts live at `<root_dir>/<stage>/<result_id>.json`. The inputs of a
+    stage should cover everything its output depends on: prompt templates,
+    model parameters and the upstream artifacts (or file digests) it reads.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def _path(self, stage: str, result_id: str) -> str:
+        return os.path.join(self.root_dir, stage, f"{result_id}.json")
+
+    def get(self, stage: str, result_id: str) -> Optional[dict]:
+        try:
+            with open(self._path(stage, result_id), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, stage: str, result_id: str, inputs_fingerprint: str, value) -> None:
+        path = self._path(stage, result_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        artifact = {
+            "fingerprint": inputs_fingerprint,
+            "created_at": time.time(),
+            "value": value,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(artifact, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def build(
+        self, stage: str, result_id: str, inputs: Any, compute: Callable[[], Any]
+    ):
+        """Return the stored output of `stage` if it was built from the same
+        `inputs`, otherwise call `compute()` and store its (JSON) output."""
+        inputs_fingerprint = fingerprint(inputs)
+        artifact = self.get(stage, result_id)
+        if artifact is not None and artifact["fingerprint"] == inputs_fingerprint:
+            return artifact["value"]
+
+        value = compute()
+        self.put(stage, result_id, inputs_fingerprint, value)
+        return value
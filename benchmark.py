@@ -0,0 +1,618 @@
+"""Offline benchmark of evaluate_results in eval_inno_dev.py and generate_tags.py.
+
+Runs the pipelines on a synthetic result tree with fake LLMs standing in for
+Azure, OpenAI and Bedrock, and reports throughput, per-stage latency
+percentiles, CPU time and peak RSS. Every script runs in its own process so
+the numbers do not bleed into each other:
+
+    python benchmark.py --results 50 --workers 8 --output bench.json
+"""
+
+import argparse
+import contextlib
+import functools
+import importlib
+import io
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import zipfile
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain.chat_models.base import SimpleChatModel
+from langchain.llms.base import LLM
+from pydantic.v1 import BaseModel
+
+import metrics
+from cascade import (
+    GEOGRAPHIC_FOCUS_LABELS,
+    IMPACT_AREA_LABELS,
+    INNOVATION_CHARACTER_LABELS,
+    INNOVATION_TYPOLOGY_LABELS,
+    MIN_READINESS_JUSTIFICATION_WORDS,
+)
+from concurrency import provider_slot
+from packing import count_tokens
+from utils import (
+    ImpactAreas,
+    ImpactAreaTags,
+    InnovationProfile,
+    Readiness,
+    ResultExtraction,
+)
+
+SCRIPTS = ("eval_inno_dev", "generate_tags")
+
+# Functions timed as pipeline stages, when the script defines them.
+STAGES = (
+    "load_data",
+    "get_structured_result",
+    "get_evidence_summary",
+    "get_readiness_level",
+    "get_geo_loc_ia_tags",
+)
+
+_WORDS = (
+    "innovation farmers maize rice seed variety yield trial field testing "
+    "prototype validated controlled conditions nutrition gender climate "
+    "adaptation poverty livelihoods Kenya Ethiopia India region national "
+    "policy capacity development training extension adoption scaling results "
+    "project evidence report survey households women youth biodiversity soil "
+    "water irrigation market value chain partners CGIAR initiative"
+).split()
+
+# A field name that only appears in the format instructions of each schema;
+# the first match decides which schema a fake chat model answers with.
+_SCHEMA_MARKERS = (
+    ("innovation_profile", ResultExtraction),
+    ("impact_justifications", ImpactAreaTags),
+    ("readiness_level_summary", Readiness),
+    ("innovation_typology", InnovationProfile),
+    ("project_title", ImpactAreas),
+)
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _fake_label(model: typing.Type[BaseModel], name: str, rng: random.Random):
+    # A value the cascade checks accept for the fields they look at, else None.
+    if name == "readiness_level":
+        if model is Readiness:
+            return str(rng.randint(0, 9))
+        return f"Level {rng.randint(1, 9)}"
+    if name == "readiness_level_summary":
+        return _text(rng, MIN_READINESS_JUSTIFICATION_WORDS + 10)
+    if name == "geographic_focus":
+        return rng.choice(GEOGRAPHIC_FOCUS_LABELS)
+    if name == "innovation_character":
+        return rng.choice(INNOVATION_CHARACTER_LABELS)
+    if name == "innovation_typology":
+        return rng.choice(INNOVATION_TYPOLOGY_LABELS)
+    if name.endswith("_tag"):
+        return rng.choice(IMPACT_AREA_LABELS)
+    return None
+
+
+def fake_instance(
+    model: typing.Type[BaseModel], rng: random.Random, valid_labels: bool = True
+) -> dict:
+    """A JSON-ready dict that `model` validates, with random words as values.
+
+    With `valid_labels`, levels and labels are ones the cascade checks accept;
+    otherwise they are random words too, and the answer gets rejected.
+    """
+    values = {}
+    for name, field in model.__fields__.items():
+        field_type = field.outer_type_
+        label = _fake_label(model, name, rng) if valid_labels else None
+        if isinstance(field_type, type) and issubclass(field_type, BaseModel):
+            values[name] = fake_instance(field_type, rng, valid_labels)
+        elif typing.get_origin(field_type) in (list, List):
+            values[name] = [_text(rng, 2)]
+        elif label is not None:
+            values[name] = label
+        else:
+            values[name] = _text(rng, 12)
+    model.parse_obj(values)
+    return values
+
+
+class Latency:
+    """Log-normal latency with the given median (seconds) and spread."""
+
+    def __init__(self, median: float, sigma: float = 0.5, seed: int = 0):
+        self.median = median
+        self.sigma = sigma
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            return self._rng.lognormvariate(math.log(self.median), self.sigma)
+
+    def sleep(self) -> None:
+        time.sleep(self.sample())
+
+
+class FakeChatModel(SimpleChatModel):
+    """Chat model answering with schema-valid JSON after a simulated delay.
+
+    A `reject_rate` share of the answers have labels the cascade checks reject,
+    so that escalations to the next model are exercised.
+    """
+
+    provider: str = "openai"
+    model_name: str = "gpt-4"
+    latency: Any = None
+    reject_rate: float = 0.0
+    seed: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"provider": self.provider, "model_name": self.model_name}
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        for marker, schema in _SCHEMA_MARKERS:
+            if marker in prompt:
+                break
+        else:
+            raise ValueError("Prompt asks for none of the known schemas")
+        with provider_slot(self.provider):
+            if self.latency is not None:
+                self.latency.sleep()
+        rng = random.Random(f"{self.seed}:{self.model_name}:{prompt}")
+        valid_labels = rng.random() >= self.reject_rate
+        text = json.dumps(fake_instance(schema, rng, valid_labels))
+        metrics.record_llm_call(
+            self.model_name, count_tokens(prompt), count_tokens(text)
+        )
+        return text
+
+
+class FakeBedrock(LLM):
+    """Stand-in for NewBedrock returning `words` words of text."""
+
+    latency: Any = None
+    words: int = 750
+    stop_markers: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-bedrock"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"words": self.words, "stop_markers": self.stop_markers}
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        with provider_slot("bedrock"):
+            if self.latency is not None:
+                self.latency.sleep()
+        text = _text(random.Random(prompt), self.words)
+        metrics.record_llm_call(
+            "anthropic.claude-v2", count_tokens(prompt), count_tokens(text)
+        )
+        return text
+
+
+def install_fake_llms(
+    module,
+    chat_latency: Latency,
+    bedrock_latency: Latency,
+    summary_words: int = 750,
+    reject_rate: float = 0.0,
+) -> None:
+    """Replace the get_llm_* factories of pipeline.py with fakes, and drop the
+    chains that `module` (a script) already built with the real clients."""
+    import pipeline
+
+    models = {
+        "get_llm_azure": ("azure", "gpt-35-turbo"),
+        "get_llm_openai": ("openai", "gpt-4"),
+        "get_llm_openai_35": ("openai", "gpt-3.5-turbo-16k"),
+    }
+    for name, (provider, model_name) in models.items():
+        fake = FakeChatModel(
+            provider=provider,
+            model_name=model_name,
+            latency=chat_latency,
+            reject_rate=reject_rate,
+            cache=False,
+        )
+        setattr(pipeline, name, lambda fake=fake: fake)
+
+    @functools.lru_cache(maxsize=None)
+    def get_llm_bedrock(*stop_markers):
+        return FakeBedrock(
+            latency=bedrock_latency,
+            words=summary_words,
+            stop_markers=list(stop_markers),
+            cache=False,
+        )
+
+    pipeline.get_llm_bedrock = get_llm_bedrock
+    for name in dir(module):
+        if name.startswith("get_") and name.endswith("_chain"):
+            getattr(module, name).cache_clear()
+
+
+# Synthetic corpus
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def pdf_bytes(pages: Sequence[str], line_chars: int = 90) -> bytes:
+    """A minimal PDF with one Helvetica text page per entry of `pages`."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for text in pages:
+        words, lines, line = text.split(), [], ""
+        for word in words:
+            if line and len(line) + len(word) + 1 > line_chars:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}" if line else word
+        lines.append(line)
+        stream = "BT /F1 9 Tf 11 TL 36 806 Td " + " ".join(
+            f"({_pdf_escape(line)}) Tj T*" for line in lines
+        )
+        stream += " ET"
+        content = stream.encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(
+        b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+        % (len(objects) + 1, xref)
+    )
+    return out.getvalue()
+
+
+def write_pptx(path: str, slides: Sequence[str]) -> None:
+    """A minimal .pptx: one text box per slide, enough for text extraction."""
+    slide_xml = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<p:sld xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+        'xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main">'
+        "<p:cSld><p:spTree><p:sp><p:txBody><a:p><a:r><a:t>{}</a:t></a:r></a:p>"
+        "</p:txBody></p:sp></p:spTree></p:cSld></p:sld>"
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as pptx:
+        pptx.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="xml" ContentType="application/xml"/></Types>',
+        )
+        for number, text in enumerate(slides, start=1):
+            pptx.writestr(f"ppt/slides/slide{number}.xml", slide_xml.format(text))
+
+
+def write_xlsx(path: str, rows: Sequence[Sequence[str]]) -> None:
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Evidence")
+    for row in rows:
+        sheet.append(list(row))
+    workbook.save(path)
+
+
+def make_corpus(
+    root: str,
+    results: int = 20,
+    result_pages: int = 3,
+    evidence_pdfs: int = 2,
+    evidence_pages: int = 20,
+    words_per_page: int = 400,
+    pptx_files: int = 1,
+    xlsx_files: int = 1,
+    seed: int = 0,
+) -> str:
+    """Write a synthetic `root_path` tree: <root>/<result id>/result.pdf plus
+    evidence PDFs, .pptx and .xlsx files of the given sizes."""
+    rng = random.Random(seed)
+    for result_id in range(1, results + 1):
+        folder = os.path.join(root, str(result_id))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "result.pdf"), "wb") as f:
+            f.write(
+                pdf_bytes([_text(rng, words_per_page) for _ in range(result_pages)])
+            )
+        for number in range(evidence_pdfs):
+            pages = [_text(rng, words_per_page) for _ in range(evidence_pages)]
+            with open(os.path.join(folder, f"evidence_{number}.pdf"), "wb") as f:
+                f.write(pdf_bytes(pages))
+        for number in range(pptx_files):
+            slides = [_text(rng, words_per_page // 4) for _ in range(evidence_pages)]
+            write_pptx(os.path.join(folder, f"slides_{number}.pptx"), slides)
+        for number in range(xlsx_files):
+            rows = [
+                [_text(rng, 6) for _ in range(6)] for _ in range(evidence_pages * 10)
+            ]
+            write_xlsx(os.path.join(folder, f"table_{number}.xlsx"), rows)
+    return root
+
+
+# Measurement
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+    }
+
+
+def _time_stages(module, timings: Dict[str, List[float]]) -> None:
+    lock = threading.Lock()
+    for name in STAGES:
+        func = getattr(module, name, None)
+        if func is None:
+            continue
+
+        @functools.wraps(func)
+        def timed(*args, _func=func, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _func(*args, **kwargs)
+            finally:
+                with lock:
+                    timings.setdefault(_name, []).append(time.perf_counter() - start)
+
+        setattr(module, name, timed)
+
+
+def run_script(
+    script: str,
+    root: str,
+    work_dir: str,
+    max_workers: int,
+    pdf_workers: int,
+    chat_latency: Latency,
+    bedrock_latency: Latency,
+    passes: Sequence[str] = ("cold", "warm"),
+    reject_rate: float = 0.0,
+) -> List[dict]:
+    """Benchmark one script in this process; one report per pass.
+
+    The "cold" pass starts with empty document and artifact caches; the
+    "warm" pass keeps the parsed documents but recomputes every stage.
+    """
+    from artifacts import ArtifactStore
+    from corpus import Corpus
+    from loaders import DocumentCache, shutdown_process_pool
+
+    module = importlib.import_module(script)
+    pipeline = importlib.import_module("pipeline")
+    install_fake_llms(module, chat_latency, bedrock_latency, reject_rate=reject_rate)
+    timings: Dict[str, List[float]] = {}
+    _time_stages(module, timings)
+    _time_stages(pipeline, timings)
+    pipeline.PDF_WORKERS = pdf_workers
+    pipeline.document_cache = DocumentCache(os.path.join(work_dir, "documents"))
+
+    reports = []
+    for number, name in enumerate(passes):
+        timings.clear()
+        module.corpus = Corpus(
+            root, manifest_path=os.path.join(work_dir, f"manifest_{number}.json")
+        )
+        module.artifact_store = ArtifactStore(os.path.join(work_dir, f"art_{number}"))
+        output_path = os.path.join(work_dir, f"output_{number}.jsonl")
+
+        cpu_before = os.times()
+        start = time.perf_counter()
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            module.evaluate_results(
+                max_workers=max_workers, output_path=output_path, resume=False
+            )
+        wall = time.perf_counter() - start
+        shutdown_process_pool()  # children's CPU and RSS count once they exit
+        cpu_after = os.times()
+
+        with open(output_path) as f:
+            completed = sum(1 for line in f if line.strip())
+        errors = log.getvalue().count("Error: Unable to evaluate result")
+        escalations = log.getvalue().count("Escalating ")
+        reports.append(
+            {
+                "script": script,
+                "pass": name,
+                "results": completed,
+                "errors": errors,
+                "escalations": escalations,
+                "wall_s": wall,
+                "results_per_s": completed / wall if wall else 0.0,
+                "cpu_user_s": cpu_after.user - cpu_before.user,
+                "cpu_system_s": cpu_after.system - cpu_before.system,
+                "children_cpu_s": (
+                    cpu_after.children_user
+                    + cpu_after.children_system
+                    - cpu_before.children_user
+                    - cpu_before.children_system
+                ),
+                # ru_maxrss is in KiB on Linux and only ever grows: it is the
+                # peak of the whole process so far.
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+                "children_peak_rss_mb": resource.getrusage(
+                    resource.RUSAGE_CHILDREN
+                ).ru_maxrss
+                / 1024,
+                "stages": {
+                    stage: percentiles(values) for stage, values in timings.items()
+                },
+            }
+        )
+    return reports
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['script']} ({report['pass']}): {report['results']} results, "
+        f"{report['errors']} errors, {report['escalations']} escalations in "
+        f"{report['wall_s']:.2f}s "
+        f"({report['results_per_s']:.2f}/s); CPU {report['cpu_user_s']:.2f}s user "
+        f"{report['cpu_system_s']:.2f}s sys, {report['children_cpu_s']:.2f}s in "
+        f"workers; peak RSS {report['peak_rss_mb']:.0f} MB "
+        f"(workers {report['children_peak_rss_mb']:.0f} MB)"
+    ]
+    for stage, stats in report["stages"].items():
+        lines.append(
+            f"  {stage:<24} n={stats['count']:<5} p50={stats['p50'] * 1000:8.1f}ms "
+            f"p90={stats['p90'] * 1000:8.1f}ms p99={stats['p99'] * 1000:8.1f}ms"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scripts", nargs="+", default=list(SCRIPTS))
+    parser.add_argument("--results", type=int, default=20)
+    parser.add_argument("--result-pages", type=int, default=3)
+    parser.add_argument("--evidence-pdfs", type=int, default=2)
+    parser.add_argument("--evidence-pages", type=int, default=20)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--pptx-files", type=int, default=1)
+    parser.add_argument("--xlsx-files", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--pdf-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="median s")
+    parser.add_argument("--bedrock-latency", type=float, default=2.0, help="median s")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument(
+        "--reject-rate",
+        type=float,
+        default=0.0,
+        help="share of chat answers the cascade rejects",
+    )
+    parser.add_argument("--corpus", help="existing synthetic tree to reuse")
+    parser.add_argument("--output", help="write the reports as JSON here")
+    # Internal: run a single script in this process and print its reports.
+    parser.add_argument("--run-script", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_script:
+        reports = run_script(
+            args.run_script,
+            args.corpus,
+            args.work_dir,
+            max_workers=args.workers,
+            pdf_workers=args.pdf_workers,
+            chat_latency=Latency(args.chat_latency, args.latency_sigma, seed=1),
+            bedrock_latency=Latency(args.bedrock_latency, args.latency_sigma, seed=2),
+            reject_rate=args.reject_rate,
+        )
+        print(json.dumps(reports))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="qa_benchmark_") as work_dir:
+        root = args.corpus
+        if root is None:
+            root = make_corpus(
+                os.path.join(work_dir, "corpus"),
+                results=args.results,
+                result_pages=args.result_pages,
+                evidence_pdfs=args.evidence_pdfs,
+                evidence_pages=args.evidence_pages,
+                words_per_page=args.words_per_page,
+                pptx_files=args.pptx_files,
+                xlsx_files=args.xlsx_files,
+            )
+
+        reports = []
+        for script in args.scripts:
+            script_dir = os.path.join(work_dir, script)
+            os.makedirs(script_dir)
+            command = [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--run-script",
+                script,
+                "--corpus",
+                root,
+                "--work-dir",
+                script_dir,
+                "--workers",
+                str(args.workers),
+                "--pdf-workers",
+                str(args.pdf_workers),
+                "--chat-latency",
+                str(args.chat_latency),
+                "--bedrock-latency",
+                str(args.bedrock_latency),
+                "--latency-sigma",
+                str(args.latency_sigma),
+                "--reject-rate",
+                str(args.reject_rate),
+            ]
+            completed = subprocess.run(
+                command, check=True, capture_output=True, text=True
+            )
+            reports.extend(json.loads(completed.stdout.splitlines()[-1]))
+
+    for report in reports:
+        print(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import json
+import re
+from typing import Callable, Sequence
+
+from pydantic.v1 import ValidationError
+
+import metrics
+from utils import ImpactAreaTags, ImpactAreas, InnovationProfile, Readiness
+
+# Part of the fingerprint of every cascaded stage: bump when the checks below
+# change which answers are accepted.
+CASCADE_VERSION = "2"
+
+# Labels accepted in each field, compared case-insensitively. "Not provided" is
+# what the extraction prompts ask for when the result PDF is silent.
+NOT_PROVIDED = "Not provided"
+IMPACT_AREA_LABELS = ("Principal", "Significant", "Not Targeted")
+GEOGRAPHIC_FOCUS_LABELS = ("Global", "Regional", "National", "Sub-national")
+INNOVATION_CHARACTER_LABELS = (
+    "Incremental innovation",
+    "Radical innovation",
+    "Disruptive innovation",
+)
+INNOVATION_TYPOLOGY_LABELS = (
+    "Technological innovation",
+    "Capacity development innovation",
+    "Policy, organizational or institutional innovation",
+)
+
+# Justifications shorter than this, or hedging about the evidence, are taken
+# as a sign the model was unsure and the next model is asked instead.
+MIN_READINESS_JUSTIFICATION_WORDS = 20
+MIN_TAG_JUSTIFICATION_WORDS = 5
+_HEDGE_RE = re.compile(
+    r"\b(?:cannot|can ?not) be (?:determined|assessed)"
+    r"|\bunable to (?:determine|assess)"
+    r"|\b(?:insufficient|not enough) (?:information|evidence)"
+    r"|\bunclear (?:whether|if)\b",
+    re.IGNORECASE,
+)
+_READINESS_LEVEL_RE = re.compile(r"\s*(?:level\s*)?[0-9]\s*", re.IGNORECASE)
+_INNOVATION_LEVEL_RE = re.compile(r"\s*level\s*[1-9]\b", re.IGNORECASE)
+
+_IMPACT_AREAS = ("gender", "climate_change", "nutrition", "environment", "poverty")
+
+
+class OutputRejected(ValueError):
+    """A model answer that is invalid or looks unreliable."""
+
+
+class SchemaRejected(OutputRejected):
+    """A model answer without the fields of its schema, which is never kept."""
+
+
+def _parse(schema, output: dict):
+    try:
+        return schema.parse_obj(output)
+    except ValidationError as e:
+        message = f"the answer does not match {schema.__name__}: {e}"
+        raise SchemaRejected(message) from e
+
+
+def _check_label(field: str, value: str, labels: Sequence[str]) -> None:
+    if value.strip().lower() not in {label.lower() for label in labels}:
+        raise OutputRejected(f"{field} {value!r} is not one of {list(labels)}")
+
+
+def _check_justification(field: str, text: str, min_words: int) -> None:
+    if len(text.split()) < min_words:
+        raise OutputRejected(f"{field} is too short")
+    hedge = _HEDGE_RE.search(text)
+    if hedge:
+        raise OutputRejected(f"{field} hedges ({hedge.group(0)!r})")
+
+
+def check_readiness(output: dict) -> None:
+    """A readiness level from 0 to 9 with a committed justification."""
+    readiness = _parse(Readiness, output)
+    if not _READINESS_LEVEL_RE.fullmatch(readiness.readiness_level):
+        raise OutputRejected(
+            f"readiness_level {readiness.readiness_level!r} is not a level 0-9"
+        )
+    _check_justification(
+        "readiness_level_summary",
+        readiness.readiness_level_summary,
+        MIN_READINESS_JUSTIFICATION_WORDS,
+    )
+
+
+def check_impact_area_tags(output: dict) -> None:
+    """Known geographic focus and impact area labels, each tag justified."""
+    tags = _parse(ImpactAreaTags, output)
+    _check_label(
+        "geographic_focus",
+        tags.geographic_location.geographic_focus,
+        (*GEOGRAPHIC_FOCUS_LABELS, NOT_PROVIDED),
+    )
+    for area in _IMPACT_AREAS:
+        _check_label(
+            f"{area}_tag",
+            getattr(tags.impact_areas, f"{area}_tag"),
+            IMPACT_AREA_LABELS,
+        )
+        _check_justification(
+            f"{area}_tag_just",
+            getattr(tags.impact_justifications, f"{area}_tag_just"),
+            MIN_TAG_JUSTIFICATION_WORDS,
+        )
+
+
+def check_innovation_profile(output: dict) -> None:
+    """Known innovation labels and a description of the innovation."""
+    profile = _parse(InnovationProfile, output)
+    if not profile.description.strip():
+        raise OutputRejected("description is empty")
+    _check_label(
+        "innovation_character",
+        profile.innovation_character,
+        (*INNOVATION_CHARACTER_LABELS, NOT_PROVIDED),
+    )
+    _check_label(
+        "innovation_typology",
+        profile.innovation_typology,
+        (*INNOVATION_TYPOLOGY_LABELS, NOT_PROVIDED),
+    )
+    if profile.readiness_level.strip().lower() != NOT_PROVIDED.lower():
+        if not _INNOVATION_LEVEL_RE.match(profile.readiness_level):
+            raise OutputRejected(
+                f"readiness_level {profile.readiness_level!r} is not a level 1-9"
+            )
+
+
+def check_impact_areas(output: dict) -> None:
+    """Known reported geographic focus and impact area labels."""
+    project = _parse(ImpactAreas, output)
+    if not project.description.description.strip():
+        raise OutputRejected("description is empty")
+    _check_label(
+        "geographic_focus",
+        project.geographic_location.geographic_focus,
+        (*GEOGRAPHIC_FOCUS_LABELS, NOT_PROVIDED),
+    )
+    for area in _IMPACT_AREAS:
+        _check_label(
+            f"{area}_tag",
+            getattr(project.impact_areas, f"{area}_tag"),
+            (*IMPACT_AREA_LABELS, NOT_PROVIDED),
+        )
+
+
+def check_result_extraction(output: dict) -> None:
+    """Both parts of the extraction shared by run_tasks.py."""
+    if not isinstance(output, dict):
+        raise SchemaRejected("the answer is not a JSON object")
+    check_innovation_profile(output.get("innovation_profile"))
+    check_impact_areas(output.get("project"))
+
+
+def run_cascade(
+    stage: str,
+    models: Sequence[str],
+    run: Callable[[str], str],
+    check: Callable[[dict], None],
+) -> dict:
+    """Parse the JSON answer of `run(model)` for each of `models` in turn,
+    returning the first that passes `check`.
+
+    Models should go from the cheapest to the strongest. The last model's
+    answer is returned even if `check` rejects its labels or justifications,
+    but it raises if the answer is not JSON or does not match the schema. Each
+    model runs as its own metrics stage "<stage>/<model>", so its latency and
+    tokens are tracked separately, and every escalation is counted in the
+    "escalations" metric of the model that was escalated from.
+    """
+    for i, model in enumerate(models):
+        last = i == len(models) - 1
+        with metrics.stage(f"{stage}/{model}"):
+            answer = run(model)
+            try:
+                output = json.loads(answer)
+                check(output)
+            except SchemaRejected as e:
+                if last:
+                    raise
+                reason = str(e)
+            except OutputRejected as e:
+                if last:
+                    print(f"Keeping the {model} answer for {stage} despite: {e}")
+                    return output
+                reason = str(e)
+            except ValueError as e:
+                if last:
+                    raise
+                reason = f"the answer is not JSON: {e}"
+            else:
+                return output
+            metrics.record(escalations=1)
+        print(f"Escalating {stage} from {model} to {models[i + 1]}: {reason}")
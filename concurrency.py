@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+# Maximum number of in-flight requests per LLM provider, shared by every worker.
+PROVIDER_CONCURRENCY = {"azure": 4, "openai": 4, "bedrock": 4}
+
+_semaphores_lock = threading.Lock()
+_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+
+
+def set_provider_concurrency(**limits: int) -> None:
+    """Override the per-provider caps, e.g. set_provider_concurrency(bedrock=2).
+
+    Call this before starting a run; slots held by in-flight calls are not
+    transferred to the new limit.
+    """
+    with _semaphores_lock:
+        for provider, limit in limits.items():
+            if limit < 1:
+                raise ValueError(f"Concurrency for {provider} must be at least 1")
+            PROVIDER_CONCURRENCY[provider] = limit
+            _semaphores[provider] = threading.BoundedSemaphore(limit)
+
+
+def _get_semaphore(provider: str) -> threading.BoundedSemaphore:
+    with _semaphores_lock:
+        semaphore = _semaphores.get(provider)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(
+                PROVIDER_CONCURRENCY.get(provider, 1)
+            )
+            _semaphores[provider] = semaphore
+        return semaphore
+
+
+@contextmanager
+def provider_slot(provider: str) -> Iterator[None]:
+    """Block until a request slot for `provider` is free and hold it."""
+    semaphore = _get_semaphore(provider)
+    with semaphore:
+        yield
+
+
+def run_concurrently(
+    func: Callable[[Any], Any], items: Iterable[Any], max_workers: int = 1
+) -> Iterator[Tuple[Any, Any, Optional[BaseException]]]:
+    """Apply `func` to every item, keeping up to `max_workers` items in flight.
+
+    Yields (item, result, error) tuples in completion order. A failing item is
+    reported through `error` and does not stop the remaining items. With
+    max_workers=1 items are processed in order on the calling thread.
+    """
+    if max_workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            error = future.exception()
+            yield item, None if error else future.result(), error
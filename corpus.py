@@ -0,0 +1,325 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional
+
+from utils import file_digest
+
+MANIFEST_VERSION = 1
+
+# Evidence file types, in the order their paths are listed for each result.
+EVIDENCE_EXTENSIONS = (".xlsx", ".pdf", ".pptx")
+
+RESULT_FILENAME = "result.pdf"
+
+
+def _scan_folder(folder_path: str, dirs: Dict[str, int], files: List[str]) -> None:
+    # One os.scandir pass per directory, visiting directories depth first and
+    # skipping hidden entries, which is the order glob("**") produced.
+    subdirs = []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file() and entry.name.endswith(EVIDENCE_EXTENSIONS):
+                files.append(entry.path)
+    dirs[folder_path] = os.stat(folder_path).st_mtime_ns
+    for subdir in subdirs:
+        _scan_folder(subdir, dirs, files)
+
+
+class CorpusIndex:
+    """Single-pass index of the result folders under `root_path`.
+
+    The index is persisted as a JSON manifest holding, for every result folder,
+    the mtimes of its directories and the path, size, mtime and sha256 of each
+    tracked file. On refresh a folder is only walked again when one of its
+    directory mtimes changed, and a file is only hashed again when its size or
+    mtime changed.
+    """
+
+    def __init__(
+        self,
+        root_path: str,
+        manifest_path: Optional[str] = None,
+        hash_files: bool = True,
+    ):
+        self.root_path = root_path
+        self.manifest_path = manifest_path or os.path.join(
+            root_path, ".corpus_manifest.json"
+        )
+        self.hash_files = hash_files
+        self.folders: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if (
+            manifest.get("version") == MANIFEST_VERSION
+            and manifest.get("root_path") == self.root_path
+        ):
+            self.folders = manifest["folders"]
+
+    def save(self) -> None:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "root_path": self.root_path,
+            "folders": self.folders,
+        }
+        directory = os.path.dirname(os.path.abspath(self.manifest_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f, self._lock:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _is_stale(self, folder: dict) -> bool:
+        for path, mtime_ns in folder["dirs"].items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def _index_folder(self, folder_path: str, previous: Optional[dict]) -> dict:
+        dirs: Dict[str, int] = {}
+        paths: List[str] = []
+        _scan_folder(folder_path, dirs, paths)
+
+        previous_files = {f["path"]: f for f in previous["files"]} if previous else {}
+        files = []
+        for path in paths:
+            stat = os.stat(path)
+            info = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            old = previous_files.get(path)
+            if (
+                old is not None
+                and old["size"] == info["size"]
+                and old["mtime_ns"] == info["mtime_ns"]
+            ):
+                info["sha256"] = old.get("sha256")
+            else:
+                info["sha256"] = None
+            if info["sha256"] is None and self.hash_files:
+                info["sha256"] = file_digest(path)
+            files.append(info)
+
+        return {"dirs": dirs, "files": files}
+
+    def refresh(self) -> int:
+        """Bring the index up to date; returns the number of folders that changed."""
+        folders = {}
+        changed = 0
+        with os.scandir(self.root_path) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.name.startswith("."):
+                    continue
+                previous = self.folders.get(entry.name)
+                if previous is None or self._is_stale(previous):
+                    folders[entry.name] = self._index_folder(entry.path, previous)
+                    changed += 1
+                else:
+                    folders[entry.name] = previous
+        changed += len(self.folders.keys() - folders.keys())
+        self.folders = folders
+        return changed
+
+    def record_file(self, path: str, sha256: str) -> None:
+        """Record a file written under the root (e.g. just downloaded) with its
+        known sha256, so the next refresh reuses the hash instead of reading
+        the file again. Thread-safe; call save() to persist."""
+        stat = os.stat(path)
+        info = {
+            "path": path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+        }
+        relative = os.path.relpath(path, self.root_path)
+        code = relative.split(os.sep, 1)[0]
+        with self._lock:
+            # A directory mtime of 0 marks a new folder as stale, so the next
+            # refresh walks it (and finds the other files) but keeps this hash.
+            folder = self.folders.setdefault(
+                code, {"dirs": {os.path.join(self.root_path, code): 0}, "files": []}
+            )
+            folder["files"] = [f for f in folder["files"] if f["path"] != path]
+            folder["files"].append(info)
+
+    def file_info(self, path: str) -> Optional[dict]:
+        relative = os.path.relpath(path, self.root_path)
+        folder = self.folders.get(relative.split(os.sep, 1)[0])
+        if folder is None:
+            return None
+        for info in folder["files"]:
+            if info["path"] == path:
+                return info
+        return None
+
+    def check_file(self, info: dict) -> bool:
+        """Hash the file of `info` again if its size or mtime changed since it
+        was indexed; returns whether it did.
+
+        A file overwritten in place leaves its directory mtime alone, so
+        refresh() keeps the old entry. Thread-safe; call save() to persist.
+        """
+        try:
+            stat = os.stat(info["path"])
+        except FileNotFoundError:
+            return False
+        if stat.st_size == info["size"] and stat.st_mtime_ns == info["mtime_ns"]:
+            return False
+        sha256 = file_digest(info["path"]) if self.hash_files else None
+        with self._lock:
+            info.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256)
+        return True
+
+    def result_map(self) -> Dict[str, Optional[str]]:
+        result_map = {}
+        for code, folder in self.folders.items():
+            path = os.path.join(self.root_path, code, RESULT_FILENAME)
+            files = {f["path"] for f in folder["files"]}
+            result_map[code] = path if path in files else None
+        return result_map
+
+    def _evidence_files(self, folder: dict) -> List[dict]:
+        # A file whose content is already listed for the result (the same PDF
+        # saved twice) is left out.
+        files = sorted(
+            (f for f in folder["files"] if not f["path"].endswith(RESULT_FILENAME)),
+            key=lambda f: EVIDENCE_EXTENSIONS.index(os.path.splitext(f["path"])[1]),
+        )
+        unique, seen = [], set()
+        for info in files:
+            if info.get("sha256") is not None:
+                if info["sha256"] in seen:
+                    continue
+                seen.add(info["sha256"])
+            unique.append(info)
+        return unique
+
+    def evidence_map(self) -> Dict[str, List[str]]:
+        return {
+            code: [f["path"] for f in self._evidence_files(folder)]
+            for code, folder in self.folders.items()
+        }
+
+    def duplicate_report(
+        self, count_tokens: Optional[Callable[[str, str], Optional[int]]] = None
+    ) -> Dict[str, int]:
+        """Evidence files that share their content with another file.
+
+        "duplicate_files" counts the copies beyond the first of each content,
+        under other results or the same one, and "duplicate_bytes" their size:
+        content that is parsed once instead of once per copy. With
+        `count_tokens(path, sha256)`, which gives the tokens of a file or None
+        when they are not known (e.g. not parsed yet), "duplicate_tokens" sums
+        the tokens of the copies, counted once per content.
+        """
+        files = duplicates = duplicate_bytes = duplicate_tokens = 0
+        seen = set()
+        tokens: Dict[str, Optional[int]] = {}
+        for folder in self.folders.values():
+            for info in folder["files"]:
+                if info["path"].endswith(RESULT_FILENAME):
+                    continue
+                files += 1
+                if info.get("sha256") is None:
+                    continue
+                if info["sha256"] in seen:
+                    duplicates += 1
+                    duplicate_bytes += info["size"]
+                    if count_tokens is not None:
+                        if info["sha256"] not in tokens:
+                            tokens[info["sha256"]] = count_tokens(
+                                info["path"], info["sha256"]
+                            )
+                        duplicate_tokens += tokens[info["sha256"]] or 0
+                seen.add(info["sha256"])
+        report = {
+            "files": files,
+            "unique_files": files - duplicates,
+            "duplicate_files": duplicates,
+            "duplicate_bytes": duplicate_bytes,
+        }
+        if count_tokens is not None:
+            report["duplicate_tokens"] = duplicate_tokens
+        return report
+
+
+class Corpus:
+    """Result folders under `root_path`, each holding result.pdf and evidence.
+
+    Nothing is read from disk until one of the maps is first accessed. The maps
+    are then built from a CorpusIndex, which is refreshed and saved once.
+    """
+
+    def __init__(self, root_path: str, manifest_path: Optional[str] = None):
+        self.root_path = root_path
+        self.index = CorpusIndex(root_path, manifest_path=manifest_path)
+        self._lock = threading.Lock()
+        self._result_map: Optional[Dict[str, Optional[str]]] = None
+        self._evidence_map: Optional[Dict[str, List[str]]] = None
+
+    @property
+    def result_map(self) -> Dict[str, Optional[str]]:
+        self._scan()
+        return self._result_map
+
+    @property
+    def evidence_map(self) -> Dict[str, List[str]]:
+        self._scan()
+        return self._evidence_map
+
+    @property
+    def result_codes(self) -> List[str]:
+        return list(self.result_map.keys())
+
+    def file_digest(self, path: str) -> Optional[str]:
+        """sha256 of `path` as recorded in the manifest, if known.
+
+        The file is hashed again (and the manifest saved) when its size or
+        mtime no longer match the manifest.
+        """
+        self._scan()
+        info = self.index.file_info(path)
+        if info is None:
+            return None
+        if self.index.check_file(info):
+            try:
+                self.index.save()
+            except OSError as e:
+                print(f"Error: Unable to save corpus manifest: {e}")
+        return info["sha256"]
+
+    def duplicate_report(
+        self, count_tokens: Optional[Callable[[str, str], Optional[int]]] = None
+    ) -> Dict[str, int]:
+        self._scan()
+        return self.index.duplicate_report(count_tokens)
+
+    def _scan(self) -> None:
+        with self._lock:
+            if self._result_map is not None:
+                return
+
+            self.index.load()
+            if self.index.refresh():
+                try:
+                    self.index.save()
+                except OSError as e:
+                    print(f"Error: Unable to save corpus manifest: {e}")
+
+            self._evidence_map = self.index.evidence_map()
+            self._result_map = self.index.result_map()
@@ -1,42 +1,62 @@
-import glob
-import json
-import os
-from typing import List
-
-from langchain.chains import LLMChain, StuffDocumentsChain
-from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
-from langchain.document_loaders import PyPDFLoader
+import functools
+import re
+from typing import TYPE_CHECKING, Optional
+
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import PromptTemplate
 from langchain.schema.document import Document
 
-from utils import InnovationProfile, NewBedrock, Readiness
-
-VERBOSE = False
-
-AZURE_OPENAI_API_BASE = "https://so-azure-openai-dev.openai.azure.com/"
-AZURE_OPENAI_API_VERSION = "2023-07-01-preview"
-AZURE_DEPLOYMENT_NAME = "gpt35-baseline"
-AZURE_OPENAI_API_KEY = ""
-AZURE_OPENAI_API_TYPE = "azure"
-
-OPENAI_API_KEY = ""
-
-
-llm_azure = AzureChatOpenAI(
-    openai_api_base=AZURE_OPENAI_API_BASE,
-    openai_api_version=AZURE_OPENAI_API_VERSION,
-    deployment_name=AZURE_DEPLOYMENT_NAME,
-    openai_api_key=AZURE_OPENAI_API_KEY,
-    openai_api_type=AZURE_OPENAI_API_TYPE,
-    temperature=0.0,
-)
-
-llm_openai = ChatOpenAI(
-    openai_api_key=OPENAI_API_KEY, model_name="gpt-4", temperature=0
+import metrics
+import pipeline
+from artifacts import ArtifactStore
+from cascade import (
+    CASCADE_VERSION,
+    check_innovation_profile,
+    check_readiness,
+    run_cascade,
 )
-
-llm_bedrock = NewBedrock(model_id="anthropic.claude-v2")
+from corpus import Corpus
+from utils import InnovationProfile, Readiness
+
+if TYPE_CHECKING:
+    from langchain.chains import StuffDocumentsChain
+
+# Loading, clients, caches and the evaluation loop are shared with
+# generate_tags.py and configured in pipeline.py.
+
+# One row per result_id, replaced when a result is evaluated again. Export the
+# Excel file with `python result_store.py export`. A .jsonl path keeps writing
+# the older append-only JSON lines file.
+OUTPUT_PATH = "/home/ubuntu/readiness_09_01_24.sqlite"
+
+# Output of each stage (structured result, evidence summary, final eval) per
+# result, with a fingerprint of the stage's inputs: a stage is only run again
+# when its prompt, model or upstream artifacts changed. To re-run results that
+# are already in OUTPUT_PATH, point OUTPUT_PATH at a new file.
+ARTIFACTS_DIR = "/home/ubuntu/.cache/ai_qa_assessment/artifacts/eval_inno_dev"
+
+# Evidence passages kept per result, ranked offline with BM25 against
+# EVIDENCE_QUERIES, before the summary call. None keeps every passage.
+EVIDENCE_TOP_K = 40
+
+# Upper bound on the (locally estimated) tokens of each Bedrock summary prompt.
+# Larger evidence is first condensed into quotes batch by batch (map-reduce).
+SUMMARY_TOKEN_BUDGET = 40_000
+
+# Stages prompted with normalized text (normalize.py): running headers and
+# footers, page numbers and reference sections removed, hyphenated line breaks
+# joined and whitespace collapsed. Leave a stage out to prompt it with the text
+# as extracted. "extraction" is left out by default: the reference cut would
+# also drop whatever the result PDF lists after a "References" heading.
+NORMALIZE_STAGES = ("summary",)
+
+# Models tried in turn, cheapest first, by the extraction and classification
+# stages: the next model is only called when an answer fails the checks in
+# cascade.py (schema, allowed labels) or looks unreliable. Escalations and the
+# time spent on each model are in the metrics ("<stage>/<model>"). A list of
+# one model turns the cascade off.
+EXTRACTION_MODELS = ["gpt35-baseline", "gpt-4"]
+CLASSIFICATION_MODELS = ["gpt-3.5-turbo-16k", "gpt-4"]
 
 result_output_parser = PydanticOutputParser(pydantic_object=InnovationProfile)
 result_format_instructions = result_output_parser.get_format_instructions()
@@ -44,10 +64,6 @@ result_format_instructions = result_output_parser.get_format_instructions()
 readiness_output_parser = PydanticOutputParser(pydantic_object=Readiness)
 readiness_format_instructions = readiness_output_parser.get_format_instructions()
 
-document_prompt = PromptTemplate(
-    input_variables=["page_content"], template="{page_content}"
-)
-
 extraction_template = (
     "You are a researcher at CGIAR. Your task is to review reports submitted by other researchers and evaluate "
     "how innovative they are across a number of dimensions. A researcher has submitted the following research results "
@@ -150,6 +166,42 @@ summary_template = (
     "\n\nAssistant:\n<summary>\n"
 )
 
+# One query per row of the innovation level table, plus the activities, testing
+# conditions and results the summary prompt asks to quote.
+EVIDENCE_QUERIES = [
+    f"{title} {definition}"
+    for title, definition in re.findall(
+        r"<title>(.*?)</title><definition>(.*?)</definition>", summary_template
+    )
+] + [
+    "activities carried out conducted implemented",
+    "tested testing trial validated controlled semi-controlled uncontrolled conditions field",
+    "results findings outcomes impact",
+]
+
+evidence_notes_template = (
+    "Human:<admin>You are a researcher at CGIAR. Your task is to review projects submitted by other researchers and evaluate "
+    "them across a number of dimensions.<admin>\n\nHuman: "
+    "The evidence for the project below is too long to review at once, so you are given one part of it.\n"
+    "Step 1: Review the project title and its description.\n"
+    "Step 2: Review the part of the evidence provided.\n"
+    "Step 3: Write down, word for word, the quotes from this part of the evidence that highlight the important activities that took place, "
+    "the findings made and any results, the setting and conditions (fully-controlled, semi-controlled or uncontrolled) of the activities carried out, "
+    "and whether activities were carried out or only planned. Also keep any quote that characterizes the innovation as a technological innovation, "
+    "a capacity development innovation or a policy/organizational/institutional innovation.\n"
+    "Return only the quotes inside <notes></notes> XML tags.\n"
+    "<project_title>\n"
+    "{short_title}\n"
+    "</project_title>\n"
+    "<description>\n"
+    "{description}\n"
+    "</description>\n"
+    "<evidence>\n"
+    "{text}\n"
+    "</evidence>"
+    "\n\nAssistant:\n<notes>\n"
+)
+
 readiness_template = (
     "You are a researcher at CGIAR. Your task is to review projects submitted by other researchers and evaluate "
     "them across a number of dimensions. This task consist of the following steps:\n"
@@ -224,137 +276,186 @@ readiness_template = (
 
 root_path = "/home/ubuntu/data/2022"
 
-_folder_paths = [f.path for f in os.scandir(root_path) if f.is_dir()]
-result_codes = [os.path.basename(f) for f in _folder_paths]
-
-ID_CODE_RESULT_MAP = {r: None for r in result_codes}
-ID_CODE_EVIDENCE_MAP = {r: [] for r in result_codes}
-
-for code in result_codes:
-    path = f"{root_path}/{code}/result.pdf"
-    if os.path.exists(path):
-        ID_CODE_RESULT_MAP[code] = path
-
-for p in _folder_paths:
-    base = os.path.basename(p)
-    files = [
-        f
-        for f in (
-            glob.glob(os.path.join(p, "**", "*.xlsx"), recursive=True)
-            + glob.glob(os.path.join(p, "**", "*.pdf"), recursive=True)
-            + glob.glob(os.path.join(p, "**", "*.pptx"), recursive=True)
-        )
-        if not f.endswith("result.pdf")
-    ]
-    ID_CODE_EVIDENCE_MAP[base].extend(files)
-
+corpus = Corpus(root_path, manifest_path=pipeline.CORPUS_MANIFEST_PATH)
 
-def load_data(result_id) -> tuple[List[Document], List[Document]]:
-    result = PyPDFLoader(ID_CODE_RESULT_MAP.get(result_id)).load_and_split()
-    evidence_list = ID_CODE_EVIDENCE_MAP.get(result_id)
+# Module attributes kept for notebooks and scripts that used the eager versions.
+__getattr__ = pipeline.lazy_attributes(__name__, lambda: corpus)
 
-    evidence_docs = []
-    if evidence_list is not None:
-        for path in evidence_list:
-            _evidence_docs = PyPDFLoader(path).load_and_split()
-            for _doc in _evidence_docs:
-                evidence_docs.append(_doc)
+artifact_store = ArtifactStore(ARTIFACTS_DIR)
 
-    return result, evidence_docs
 
+def _default_corpus() -> Corpus:
+    return corpus
 
-def get_structured_result(result) -> dict:
-    llm_chain = LLMChain(llm=llm_azure, prompt=extraction_prompt, verbose=VERBOSE)
-    stuff_chain = StuffDocumentsChain(
-        llm_chain=llm_chain,
-        document_prompt=document_prompt,
-        document_variable_name="text",
-        verbose=VERBOSE,
-    )
-    _structured_result = stuff_chain.run({"input_documents": result})
-    structured_result = json.loads(_structured_result)
 
-    return structured_result
+# Chains are built once and shared by every result and worker thread; values
+# that change per result (short_title, description) are passed as inputs.
+@functools.lru_cache(maxsize=None)
+def get_extraction_chain(model: str) -> "StuffDocumentsChain":
+    return pipeline.stuff_chain(pipeline.get_llm(model), extraction_prompt)
 
 
-def get_evidence_summary(evidence_docs, structured_result) -> str:
-    short_title = structured_result["short_title"]
-    description = structured_result["description"]
-    summary_prompt = PromptTemplate.from_template(
-        template=summary_template,
-        partial_variables={"short_title": short_title, "description": description},
+@functools.lru_cache(maxsize=None)
+def get_notes_chain() -> "StuffDocumentsChain":
+    notes_prompt = PromptTemplate.from_template(template=evidence_notes_template)
+    return pipeline.stuff_chain(
+        pipeline.get_llm_bedrock(pipeline.NOTES_STOP_MARKER), notes_prompt
     )
-    llm_chain = LLMChain(llm=llm_bedrock, prompt=summary_prompt, verbose=VERBOSE)
-    stuff_chain = StuffDocumentsChain(
-        llm_chain=llm_chain,
-        document_prompt=document_prompt,
-        document_variable_name="text",
-        verbose=VERBOSE,
-    )
-    evidence_summary = stuff_chain.run({"input_documents": evidence_docs})
 
-    return evidence_summary
 
+@functools.lru_cache(maxsize=None)
+def get_summary_chain() -> "StuffDocumentsChain":
+    summary_prompt = PromptTemplate.from_template(template=summary_template)
+    return pipeline.stuff_chain(
+        pipeline.get_llm_bedrock(pipeline.SUMMARY_STOP_MARKER), summary_prompt
+    )
 
-def get_readiness_level(evidence_summary) -> str:
+
+@functools.lru_cache(maxsize=None)
+def get_readiness_chain(model: str) -> "StuffDocumentsChain":
     readiness_prompt = PromptTemplate.from_template(
         template=readiness_template,
         partial_variables={
             "format_instructions": readiness_format_instructions,
         },
     )
-    llm_chain = LLMChain(llm=llm_openai, prompt=readiness_prompt, verbose=VERBOSE)
-    stuff_chain = StuffDocumentsChain(
-        llm_chain=llm_chain,
-        document_prompt=document_prompt,
-        document_variable_name="text",
-        verbose=VERBOSE,
+    return pipeline.stuff_chain(pipeline.get_llm(model), readiness_prompt)
+
+
+def get_structured_result(result) -> dict:
+    structured_result = run_cascade(
+        "extraction",
+        EXTRACTION_MODELS,
+        lambda model: get_extraction_chain(model).run({"input_documents": result}),
+        check_innovation_profile,
     )
+
+    return structured_result
+
+
+def _project(structured_result) -> dict:
+    return {
+        "short_title": structured_result["short_title"],
+        "description": structured_result["description"],
+    }
+
+
+def get_evidence_summary(evidence_docs, structured_result) -> str:
+    evidence_summary = pipeline.summarize_evidence(
+        evidence_docs,
+        _project(structured_result),
+        get_notes_chain(),
+        get_summary_chain(),
+        EVIDENCE_QUERIES,
+        EVIDENCE_TOP_K,
+        SUMMARY_TOKEN_BUDGET,
+    )
+
+    return evidence_summary
+
+
+def get_readiness_level(evidence_summary) -> str:
     _evidence_summary = [
         Document(page_content=evidence_summary, metadata={"source": "Claude v2"})
     ]
-    _structured_readiness_eval = stuff_chain.run({"input_documents": _evidence_summary})
-    structured_readiness_eval = json.loads(_structured_readiness_eval)
-    # structured_readiness_eval = ast.literal_eval(_structured_readiness_eval)
+    structured_readiness_eval = run_cascade(
+        "classification",
+        CLASSIFICATION_MODELS,
+        lambda model: get_readiness_chain(model).run(
+            {"input_documents": _evidence_summary}
+        ),
+        check_readiness,
+    )
 
     return structured_readiness_eval
 
 
-def evaluate_results() -> None:
-    for result_id in ID_CODE_RESULT_MAP.keys():
-        # if (
-        #     result_id
-        #     in (
-        #     )
-        # ):  # 791, 1876, 2097 - Bedrock timeout; 1035 - Bedrock input too long; 2171, 3418, 1103 - .pptx; 856, 2168, 2104, 3018, 2050 - paywall or no evidence
-        #     continue
-        print(f"Evaluating result {result_id}...")
-        print("Loading PRMS result and evidence...")
-        result, evidence_docs = load_data(result_id)
+def _evaluate_result(
+    result_id, load=None, structured_result=None, corpus: Optional[Corpus] = None
+) -> dict:
+    # `load` and `structured_result` let run_tasks.py share the parsed documents
+    # and a single extraction between tasks, and `corpus` its result tree.
+    # Documents are only parsed when a stage below actually needs to run.
+    print(f"Evaluating result {result_id}...")
+    corpus = corpus or _default_corpus()
+    load = load or pipeline.lazy_loader(result_id, corpus)
+
+    if structured_result is None:
         print("Getting structured result...")
-        structured_result = get_structured_result(result)
-        print("Getting summary of evidence...")
-        evidence_summary = get_evidence_summary(evidence_docs, structured_result)
-        print("Getting readiness level...")
-        structured_readiness_eval = get_readiness_level(evidence_summary)
-        output = {
-            "result_id": result_id,
-            "reported_readiness_level": structured_result["readiness_level"],
-            "reported_readiness_justif": structured_result["readiness_justif"],
-            "ai_readiness_level": structured_readiness_eval["readiness_level"],
-            "ai_readiness_justif": structured_readiness_eval["readiness_level_summary"],
-        }
-
-        with open(
-            "/home/ubuntu/readiness_09_01_24.jsonl", "a"
-        ) as f:  # updates to .jsonl
-            json.dump(output, f)
-            f.write("\n")
-
-        print(output)
+        structured_result = pipeline.build_structured_result(
+            artifact_store,
+            result_id,
+            corpus,
+            load,
+            {
+                "template": extraction_template,
+                "format_instructions": result_format_instructions,
+                "models": pipeline.model_fingerprints(EXTRACTION_MODELS),
+                "cascade": CASCADE_VERSION,
+            },
+            get_structured_result,
+            normalize="extraction" in NORMALIZE_STAGES,
+        )
+    print("Getting summary of evidence...")
+    evidence_summary = pipeline.build_evidence_summary(
+        artifact_store,
+        result_id,
+        corpus,
+        load,
+        {
+            "templates": [evidence_notes_template, summary_template],
+            **_project(structured_result),
+            "queries": EVIDENCE_QUERIES,
+            "top_k": EVIDENCE_TOP_K,
+            "token_budget": SUMMARY_TOKEN_BUDGET,
+        },
+        lambda evidence_docs: get_evidence_summary(evidence_docs, structured_result),
+        normalize="summary" in NORMALIZE_STAGES,
+    )
+    print("Getting readiness level...")
+    with metrics.stage("classification"):
+        structured_readiness_eval = artifact_store.build(
+            "readiness",
+            result_id,
+            {
+                "template": readiness_template,
+                "format_instructions": readiness_format_instructions,
+                "models": pipeline.model_fingerprints(CLASSIFICATION_MODELS),
+                "cascade": CASCADE_VERSION,
+                "evidence_summary": evidence_summary,
+            },
+            lambda: get_readiness_level(evidence_summary),
+        )
+    output = {
+        "result_id": result_id,
+        "reported_readiness_level": structured_result["readiness_level"],
+        "reported_readiness_justif": structured_result["readiness_justif"],
+        "ai_readiness_level": structured_readiness_eval["readiness_level"],
+        "ai_readiness_justif": structured_readiness_eval["readiness_level_summary"],
+    }
 
     return output
 
 
+def evaluate_result(
+    result_id, load=None, structured_result=None, corpus: Optional[Corpus] = None
+) -> dict:
+    return pipeline.evaluate_tracked(
+        "eval_inno_dev", _evaluate_result, result_id, load, structured_result, corpus
+    )
+
+
+def evaluate_results(
+    max_workers=pipeline.MAX_WORKERS, output_path=OUTPUT_PATH, resume=True
+) -> None:
+    return pipeline.evaluate_results(
+        evaluate_result,
+        corpus,
+        max_workers=max_workers,
+        output_path=output_path,
+        resume=resume,
+    )
+
+
 if __name__ == "__main__":
     result = evaluate_results()
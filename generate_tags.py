@@ -1,46 +1,61 @@
-import glob
-import json
-import os
-from typing import List
-
-from langchain.chains import LLMChain, StuffDocumentsChain
-from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
-from langchain.document_loaders import PyPDFLoader
+import functools
+from typing import TYPE_CHECKING, Optional
+
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import PromptTemplate
 from langchain.schema.document import Document
 
-from utils import ImpactAreas, ImpactAreaTags, NewBedrock
-
-VERBOSE = False
-
-AZURE_OPENAI_API_BASE = "https://so-azure-openai-dev.openai.azure.com/"
-AZURE_OPENAI_API_VERSION = "2023-07-01-preview"
-AZURE_DEPLOYMENT_NAME = "gpt35-baseline"
-AZURE_OPENAI_API_KEY = ""
-AZURE_OPENAI_API_TYPE = "azure"
-
-OPENAI_API_KEY = ""
-
-
-llm_azure = AzureChatOpenAI(
-    openai_api_base=AZURE_OPENAI_API_BASE,
-    openai_api_version=AZURE_OPENAI_API_VERSION,
-    deployment_name=AZURE_DEPLOYMENT_NAME,
-    openai_api_key=AZURE_OPENAI_API_KEY,
-    openai_api_type=AZURE_OPENAI_API_TYPE,
-    temperature=0.0,
-)
-
-llm_openai = ChatOpenAI(
-    openai_api_key=OPENAI_API_KEY, model_name="gpt-4", temperature=0
+import metrics
+import pipeline
+from artifacts import ArtifactStore
+from cascade import (
+    CASCADE_VERSION,
+    check_impact_area_tags,
+    check_impact_areas,
+    run_cascade,
 )
-
-llm_openai_35 = ChatOpenAI(
-    openai_api_key=OPENAI_API_KEY, model_name="gpt-3.5-turbo-16k", temperature=0
-)
-
-llm_bedrock = NewBedrock(model_id="anthropic.claude-v2")
+from corpus import Corpus
+from utils import ImpactAreas, ImpactAreaTags
+
+if TYPE_CHECKING:
+    from langchain.chains import StuffDocumentsChain
+
+# Loading, clients, caches and the evaluation loop are shared with
+# eval_inno_dev.py and configured in pipeline.py.
+
+# One row per result_id, replaced when a result is evaluated again. Export the
+# Excel file with `python result_store.py export`. A .jsonl path keeps writing
+# the older append-only JSON lines file.
+OUTPUT_PATH = "/home/ubuntu/geo_loc_ia_tags_09_01_24.sqlite"
+
+# Output of each stage (structured result, evidence summary, final eval) per
+# result, with a fingerprint of the stage's inputs: a stage is only run again
+# when its prompt, model or upstream artifacts changed. To re-run results that
+# are already in OUTPUT_PATH, point OUTPUT_PATH at a new file.
+ARTIFACTS_DIR = "/home/ubuntu/.cache/ai_qa_assessment/artifacts/generate_tags"
+
+# Evidence passages kept per result, ranked offline with BM25 against
+# EVIDENCE_QUERIES, before the summary call. None keeps every passage.
+EVIDENCE_TOP_K = 40
+
+# Upper bound on the (locally estimated) tokens of each Bedrock summary prompt.
+# Larger evidence is first condensed into quotes batch by batch (map-reduce).
+SUMMARY_TOKEN_BUDGET = 40_000
+
+# Stages prompted with normalized text (normalize.py): running headers and
+# footers, page numbers and reference sections removed, hyphenated line breaks
+# joined and whitespace collapsed. Leave a stage out to prompt it with the text
+# as extracted. "extraction" is left out by default: the reference cut would
+# also drop whatever the result PDF lists after a "References" heading.
+NORMALIZE_STAGES = ("summary",)
+
+# Models tried in turn, cheapest first, by the extraction and classification
+# stages: the next model is only called when an answer fails the checks in
+# cascade.py (schema, allowed labels) or looks unreliable. Escalations and the
+# time spent on each model are in the metrics ("<stage>/<model>"). A list of
+# one model turns the cascade off.
+EXTRACTION_MODELS = ["gpt-3.5-turbo-16k", "gpt-4"]
+CLASSIFICATION_MODELS = ["gpt-3.5-turbo-16k", "gpt-4"]
 
 result_output_parser = PydanticOutputParser(pydantic_object=ImpactAreas)
 result_format_instructions = result_output_parser.get_format_instructions()
@@ -50,10 +65,6 @@ geo_loc_ia_tags_format_instructions = (
     geo_loc_ia_tags_output_parser.get_format_instructions()
 )
 
-document_prompt = PromptTemplate(
-    input_variables=["page_content"], template="{page_content}"
-)
-
 extraction_template = (
     "You are a researcher at CGIAR. Your task is to review reports submitted by other researchers and evaluate "
     "how innovative they are across a number of dimensions. A researcher has submitted the following research results "
@@ -111,6 +122,29 @@ summary_template = (
     "\n\nAssistant:\n<summary>\n"
 )
 
+evidence_notes_template = (
+    "Human:<admin>You are a researcher at CGIAR. Your task is to review projects submitted by other researchers and evaluate "
+    "them across a number of dimensions.<admin>\n\nHuman: "
+    "The evidence for the project below is too long to review at once, so you are given one part of it.\n"
+    "Step 1: Review the project title and its description.\n"
+    "Step 2: Review the part of the evidence provided.\n"
+    "Step 3: Write down, word for word, the quotes from this part of the evidence that highlight the important activities that took place, "
+    "the findings made and any results, the geographic focus of these activities (countries, regions or sub-national areas) and any of the "
+    "following topics of interest they explicitly reference: nutrition, health, food security, poverty reduction, livelihood, jobs, gender equality, "
+    "youth inlcusion, social inclusion, climate adaptation, climate mitigation, environmental health, and biodiversity.\n"
+    "Return only the quotes inside <notes></notes> XML tags.\n"
+    "<project_title>\n"
+    "{project_title}\n"
+    "</project_title>\n"
+    "<description>\n"
+    "{description}\n"
+    "</description>\n"
+    "<evidence>\n"
+    "{text}\n"
+    "</evidence>"
+    "\n\nAssistant:\n<notes>\n"
+)
+
 GEO_LOC_LABELS = """
 The labels for Geographic focus are: 'Global', 'Regional', 'National', 'Sub-national'.
 The labels for Region are all the United Nations geoscheme subregions".
@@ -137,6 +171,15 @@ Below is a lookup table of CGIAR strategic objectives and their definitions.
 | Poverty reduction, livelihoods and jobs | Poverty | Reduce by at least half the proportion of men, women and children of all ages living in poverty in all its dimensions, according to national definitions. |
 """
 
+# One query per impact area objective, plus the geographic focus.
+EVIDENCE_QUERIES = [
+    " ".join(row.split("|")[1:4])
+    for row in IA_OBJECTIVES.splitlines()
+    if row.startswith("| ") and not row.startswith("| Impact Area |")
+] + [
+    "country countries region regional national sub-national district province global",
+]
+
 IA_LABELS = """
 The Impact Area labels are defined as follows:
 
@@ -172,84 +215,45 @@ geo_loc_ia_tags_template = (
     "Only return the resulting JSON object. DO NOT return any other text."
 )
 
-
 root_path = "/home/ubuntu/data/2023"
 
-_folder_paths = [f.path for f in os.scandir(root_path) if f.is_dir()]
-result_codes = [os.path.basename(f) for f in _folder_paths]
-
-ID_CODE_RESULT_MAP = {r: None for r in result_codes}
-ID_CODE_EVIDENCE_MAP = {r: [] for r in result_codes}
-
-for code in result_codes:
-    path = f"{root_path}/{code}/result.pdf"
-    if os.path.exists(path):
-        ID_CODE_RESULT_MAP[code] = path
-
-for p in _folder_paths:
-    base = os.path.basename(p)
-    files = [
-        f
-        for f in (
-            glob.glob(os.path.join(p, "**", "*.xlsx"), recursive=True)
-            + glob.glob(os.path.join(p, "**", "*.pdf"), recursive=True)
-            + glob.glob(os.path.join(p, "**", "*.pptx"), recursive=True)
-        )
-        if not f.endswith("result.pdf")
-    ]
-    ID_CODE_EVIDENCE_MAP[base].extend(files)
-
+corpus = Corpus(root_path, manifest_path=pipeline.CORPUS_MANIFEST_PATH)
 
-def load_data(result_id) -> tuple[List[Document], List[Document]]:
-    result = PyPDFLoader(ID_CODE_RESULT_MAP.get(result_id)).load_and_split()
-    evidence_list = ID_CODE_EVIDENCE_MAP.get(result_id)
+# Module attributes kept for notebooks and scripts that used the eager versions.
+__getattr__ = pipeline.lazy_attributes(__name__, lambda: corpus)
 
-    evidence_docs = []
-    if evidence_list is not None:
-        for path in evidence_list:
-            _evidence_docs = PyPDFLoader(path).load_and_split()
-            for _doc in _evidence_docs:
-                evidence_docs.append(_doc)
+artifact_store = ArtifactStore(ARTIFACTS_DIR)
 
-    return result, evidence_docs
 
+def _default_corpus() -> Corpus:
+    return corpus
 
-def get_structured_result(result) -> dict:
-    llm_chain = LLMChain(
-        llm=llm_openai_35, prompt=extraction_prompt, verbose=VERBOSE
-    )  # previously - llm=llm_azure
-    stuff_chain = StuffDocumentsChain(
-        llm_chain=llm_chain,
-        document_prompt=document_prompt,
-        document_variable_name="text",
-        verbose=VERBOSE,
-    )
-    _structured_result = stuff_chain.run({"input_documents": result})
-    structured_result = json.loads(_structured_result)
 
-    return structured_result
+# Chains are built once and shared by every result and worker thread; values
+# that change per result (project_title, description) are passed as inputs.
+@functools.lru_cache(maxsize=None)
+def get_extraction_chain(model: str) -> "StuffDocumentsChain":
+    return pipeline.stuff_chain(pipeline.get_llm(model), extraction_prompt)
 
 
-def get_evidence_summary(evidence_docs, structured_result) -> str:
-    project_title = structured_result["project_title"]
-    description = structured_result["description"]["description"]
-    summary_prompt = PromptTemplate.from_template(
-        template=summary_template,
-        partial_variables={"project_title": project_title, "description": description},
-    )
-    llm_chain = LLMChain(llm=llm_bedrock, prompt=summary_prompt, verbose=VERBOSE)
-    stuff_chain = StuffDocumentsChain(
-        llm_chain=llm_chain,
-        document_prompt=document_prompt,
-        document_variable_name="text",
-        verbose=VERBOSE,
+@functools.lru_cache(maxsize=None)
+def get_notes_chain() -> "StuffDocumentsChain":
+    notes_prompt = PromptTemplate.from_template(template=evidence_notes_template)
+    return pipeline.stuff_chain(
+        pipeline.get_llm_bedrock(pipeline.NOTES_STOP_MARKER), notes_prompt
     )
-    evidence_summary = stuff_chain.run({"input_documents": evidence_docs})
 
-    return evidence_summary
 
+@functools.lru_cache(maxsize=None)
+def get_summary_chain() -> "StuffDocumentsChain":
+    summary_prompt = PromptTemplate.from_template(template=summary_template)
+    return pipeline.stuff_chain(
+        pipeline.get_llm_bedrock(pipeline.SUMMARY_STOP_MARKER), summary_prompt
+    )
 
-def get_geo_loc_ia_tags(evidence_summary) -> str:
+
+@functools.lru_cache(maxsize=None)
+def get_geo_loc_ia_tags_chain(model: str) -> "StuffDocumentsChain":
     geo_loc_ia_tags_prompt = PromptTemplate.from_template(
         template=geo_loc_ia_tags_template,
         partial_variables={
@@ -259,95 +263,182 @@ def get_geo_loc_ia_tags(evidence_summary) -> str:
             "format_instructions": geo_loc_ia_tags_format_instructions,
         },
     )
-    llm_chain = LLMChain(llm=llm_openai, prompt=geo_loc_ia_tags_prompt, verbose=VERBOSE)
-    stuff_chain = StuffDocumentsChain(
-        llm_chain=llm_chain,
-        document_prompt=document_prompt,
-        document_variable_name="text",
-        verbose=VERBOSE,
+    return pipeline.stuff_chain(pipeline.get_llm(model), geo_loc_ia_tags_prompt)
+
+
+def get_structured_result(result) -> dict:
+    structured_result = run_cascade(
+        "extraction",
+        EXTRACTION_MODELS,
+        lambda model: get_extraction_chain(model).run({"input_documents": result}),
+        check_impact_areas,
+    )
+
+    return structured_result
+
+
+def _project(structured_result) -> dict:
+    return {
+        "project_title": structured_result["project_title"],
+        "description": structured_result["description"]["description"],
+    }
+
+
+def get_evidence_summary(evidence_docs, structured_result) -> str:
+    evidence_summary = pipeline.summarize_evidence(
+        evidence_docs,
+        _project(structured_result),
+        get_notes_chain(),
+        get_summary_chain(),
+        EVIDENCE_QUERIES,
+        EVIDENCE_TOP_K,
+        SUMMARY_TOKEN_BUDGET,
     )
+
+    return evidence_summary
+
+
+def get_geo_loc_ia_tags(evidence_summary) -> str:
     _evidence_summary = [
         Document(page_content=evidence_summary, metadata={"source": "Claude v2"})
     ]
-    _structured_geo_loc_ia_tags = stuff_chain.run(
-        {"input_documents": _evidence_summary}
+    structured_geo_loc_ia_tags = run_cascade(
+        "classification",
+        CLASSIFICATION_MODELS,
+        lambda model: get_geo_loc_ia_tags_chain(model).run(
+            {"input_documents": _evidence_summary}
+        ),
+        check_impact_area_tags,
     )
-    structured_geo_loc_ia_tags = json.loads(_structured_geo_loc_ia_tags)
 
     return structured_geo_loc_ia_tags
 
 
-def evaluate_results() -> None:
-    for result_id in ID_CODE_RESULT_MAP.keys():
-        print(f"Evaluating result {result_id}...")
-        print("Loading PRMS result and evidence...")
-        result, evidence_docs = load_data(result_id)
+def _evaluate_result(
+    result_id, load=None, structured_result=None, corpus: Optional[Corpus] = None
+) -> dict:
+    # `load` and `structured_result` let run_tasks.py share the parsed documents
+    # and a single extraction between tasks, and `corpus` its result tree.
+    # Documents are only parsed when a stage below actually needs to run.
+    print(f"Evaluating result {result_id}...")
+    corpus = corpus or _default_corpus()
+    load = load or pipeline.lazy_loader(result_id, corpus)
+
+    if structured_result is None:
         print("Getting structured result...")
-        structured_result = get_structured_result(result)
-        print("Getting summary of evidence...")
-        evidence_summary = get_evidence_summary(evidence_docs, structured_result)
-        print("Getting geographic location and impact area tags...")
-        structured_geo_loc_ia_tags = get_geo_loc_ia_tags(evidence_summary)
-
-        output = {
-            "result_id": result_id,
-            "reported_geographic_focus": structured_result["geographic_location"][
-                "geographic_focus"
-            ],
-            "reported_region": structured_result["geographic_location"]["region"],
-            "reported_country": structured_result["geographic_location"]["country"],
-            "reported_gender_tag": structured_result["impact_areas"]["gender_tag"],
-            "reported_climate_tag": structured_result["impact_areas"][
-                "climate_change_tag"
-            ],
-            "reported_nutrition_tag": structured_result["impact_areas"][
-                "nutrition_tag"
-            ],
-            "reported_environment_tag": structured_result["impact_areas"][
-                "environment_tag"
-            ],
-            "reported_poverty_tag": structured_result["impact_areas"]["poverty_tag"],
-            "ai_geographic_focus": structured_geo_loc_ia_tags["geographic_location"][
-                "geographic_focus"
-            ],
-            "ai_region": structured_geo_loc_ia_tags["geographic_location"]["region"],
-            "ai_country": structured_geo_loc_ia_tags["geographic_location"]["country"],
-            "ai_gender_tag": structured_geo_loc_ia_tags["impact_areas"]["gender_tag"],
-            "ai_climate_tag": structured_geo_loc_ia_tags["impact_areas"][
-                "climate_change_tag"
-            ],
-            "ai_nutrition_tag": structured_geo_loc_ia_tags["impact_areas"][
-                "nutrition_tag"
-            ],
-            "ai_environment_tag": structured_geo_loc_ia_tags["impact_areas"][
-                "environment_tag"
-            ],
-            "ai_poverty_tag": structured_geo_loc_ia_tags["impact_areas"]["poverty_tag"],
-            "ai_gender_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
-                "gender_tag_just"
-            ],
-            "ai_climate_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
-                "climate_change_tag_just"
-            ],
-            "ai_nutrition_tag_just": structured_geo_loc_ia_tags[
-                "impact_justifications"
-            ]["nutrition_tag_just"],
-            "ai_environment_tag_just": structured_geo_loc_ia_tags[
-                "impact_justifications"
-            ]["environment_tag_just"],
-            "ai_poverty_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
-                "poverty_tag_just"
-            ],
-        }
-
-        with open("/home/ubuntu/geo_loc_ia_tags_09_01_24.jsonl", "a") as f:
-            json.dump(output, f)
-            f.write("\n")
-
-        print(output)
+        structured_result = pipeline.build_structured_result(
+            artifact_store,
+            result_id,
+            corpus,
+            load,
+            {
+                "template": extraction_template,
+                "format_instructions": result_format_instructions,
+                "models": pipeline.model_fingerprints(EXTRACTION_MODELS),
+                "cascade": CASCADE_VERSION,
+            },
+            get_structured_result,
+            normalize="extraction" in NORMALIZE_STAGES,
+        )
+    print("Getting summary of evidence...")
+    evidence_summary = pipeline.build_evidence_summary(
+        artifact_store,
+        result_id,
+        corpus,
+        load,
+        {
+            "templates": [evidence_notes_template, summary_template],
+            **_project(structured_result),
+            "queries": EVIDENCE_QUERIES,
+            "top_k": EVIDENCE_TOP_K,
+            "token_budget": SUMMARY_TOKEN_BUDGET,
+        },
+        lambda evidence_docs: get_evidence_summary(evidence_docs, structured_result),
+        normalize="summary" in NORMALIZE_STAGES,
+    )
+    print("Getting geographic location and impact area tags...")
+    with metrics.stage("classification"):
+        structured_geo_loc_ia_tags = artifact_store.build(
+            "geo_loc_ia_tags",
+            result_id,
+            {
+                "template": geo_loc_ia_tags_template,
+                "labels": [GEO_LOC_LABELS, IA_OBJECTIVES, IA_LABELS],
+                "format_instructions": geo_loc_ia_tags_format_instructions,
+                "models": pipeline.model_fingerprints(CLASSIFICATION_MODELS),
+                "cascade": CASCADE_VERSION,
+                "evidence_summary": evidence_summary,
+            },
+            lambda: get_geo_loc_ia_tags(evidence_summary),
+        )
+
+    output = {
+        "result_id": result_id,
+        "reported_geographic_focus": structured_result["geographic_location"][
+            "geographic_focus"
+        ],
+        "reported_region": structured_result["geographic_location"]["region"],
+        "reported_country": structured_result["geographic_location"]["country"],
+        "reported_gender_tag": structured_result["impact_areas"]["gender_tag"],
+        "reported_climate_tag": structured_result["impact_areas"]["climate_change_tag"],
+        "reported_nutrition_tag": structured_result["impact_areas"]["nutrition_tag"],
+        "reported_environment_tag": structured_result["impact_areas"][
+            "environment_tag"
+        ],
+        "reported_poverty_tag": structured_result["impact_areas"]["poverty_tag"],
+        "ai_geographic_focus": structured_geo_loc_ia_tags["geographic_location"][
+            "geographic_focus"
+        ],
+        "ai_region": structured_geo_loc_ia_tags["geographic_location"]["region"],
+        "ai_country": structured_geo_loc_ia_tags["geographic_location"]["country"],
+        "ai_gender_tag": structured_geo_loc_ia_tags["impact_areas"]["gender_tag"],
+        "ai_climate_tag": structured_geo_loc_ia_tags["impact_areas"][
+            "climate_change_tag"
+        ],
+        "ai_nutrition_tag": structured_geo_loc_ia_tags["impact_areas"]["nutrition_tag"],
+        "ai_environment_tag": structured_geo_loc_ia_tags["impact_areas"][
+            "environment_tag"
+        ],
+        "ai_poverty_tag": structured_geo_loc_ia_tags["impact_areas"]["poverty_tag"],
+        "ai_gender_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
+            "gender_tag_just"
+        ],
+        "ai_climate_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
+            "climate_change_tag_just"
+        ],
+        "ai_nutrition_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
+            "nutrition_tag_just"
+        ],
+        "ai_environment_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
+            "environment_tag_just"
+        ],
+        "ai_poverty_tag_just": structured_geo_loc_ia_tags["impact_justifications"][
+            "poverty_tag_just"
+        ],
+    }
 
     return output
 
 
+def evaluate_result(
+    result_id, load=None, structured_result=None, corpus: Optional[Corpus] = None
+) -> dict:
+    return pipeline.evaluate_tracked(
+        "generate_tags", _evaluate_result, result_id, load, structured_result, corpus
+    )
+
+
+def evaluate_results(
+    max_workers=pipeline.MAX_WORKERS, output_path=OUTPUT_PATH, resume=True
+) -> None:
+    return pipeline.evaluate_results(
+        evaluate_result,
+        corpus,
+        max_workers=max_workers,
+        output_path=output_path,
+        resume=resume,
+    )
+
+
 if __name__ == "__main__":
     result = evaluate_results()
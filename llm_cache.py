@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from langchain.globals import set_llm_cache
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema.cache import RETURN_VAL_TYPE, BaseCache
+from langchain.schema.output import Generation
+
+# Bump to invalidate every cached response, e.g. after changing how outputs
+# are post-processed.
+CACHE_VERSION = "1"
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+)
+"""
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    # llm_string is langchain's serialization of the model id and generation
+    # parameters (temperature, max tokens, stop, ...).
+    payload = "\x00".join((CACHE_VERSION, llm_string, prompt))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PersistentLLMCache(BaseCache):
+    """SQLite-backed langchain cache keyed on a hash of model, params and prompt.
+
+    Each thread gets its own connection and the database runs in WAL mode, so
+    the cache can be shared by concurrent workers and by several processes.
+    Entries older than `max_age` seconds are ignored and purged, and the least
+    recently used entries are dropped once the responses exceed `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_age: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        evict_every: int = 100,
+    ):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._updates = 0
+        self._updates_lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(_CREATE_TABLE)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_accessed_at "
+                "ON llm_cache (accessed_at)"
+            )
+        self.evict()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = cache_key(prompt, llm_string)
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        response, created_at = row
+        now = time.time()
+        if self.max_age is not None and now - created_at > self.max_age:
+            return None
+
+        try:
+            generations = [loads(item) for item in json.loads(response)]
+        except Exception:
+            return None
+
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+        except sqlite3.OperationalError:
+            pass  # recency is best effort; a locked database must not fail a hit
+
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        for gen in return_val:
+            if not isinstance(gen, Generation):
+                return
+
+        response = json.dumps([dumps(gen) for gen in return_val])
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache "
+                "(key, response, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (cache_key(prompt, llm_string), response, len(response), now, now),
+            )
+
+        with self._updates_lock:
+            self._updates += 1
+            evict = self._updates % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        with self._connection() as conn:
+            if self.max_age is not None:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE created_at < ?",
+                    (time.time() - self.max_age,),
+                )
+            if self.max_bytes is not None:
+                (total,) = conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM llm_cache"
+                ).fetchone()
+                if total > self.max_bytes:
+                    excess = total - self.max_bytes
+                    rows = conn.execute(
+                        "SELECT key, size FROM llm_cache ORDER BY accessed_at"
+                    )
+                    stale = []
+                    for key, size in rows:
+                        if excess <= 0:
+                            break
+                        stale.append((key,))
+                        excess -= size
+                    conn.executemany("DELETE FROM llm_cache WHERE key = ?", stale)
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM llm_cache")
+
+
+def install_llm_cache(
+    path: str, max_age: Optional[float] = None, max_bytes: Optional[int] = None
+) -> PersistentLLMCache:
+    """Route every langchain LLM and chat model call through a persistent cache."""
+    cache = PersistentLLMCache(path, max_age=max_age, max_bytes=max_bytes)
+    set_llm_cache(cache)
+    return cache
@@ -0,0 +1,308 @@
+import contextlib
+import functools
+import itertools
+import json
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping
+
+import boto3
+import openai
+import requests
+from botocore.config import Config
+from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
+from langchain.llms.bedrock import HUMAN_PROMPT, Bedrock, LLMInputOutputAdapter
+from langchain.pydantic_v1 import root_validator
+from langchain.schema.output import GenerationChunk
+
+import metrics
+from concurrency import provider_slot
+from packing import count_tokens
+from rate_limit import call_with_retry, get_rate_limiter
+
+AWS_REGION = "us-east-1"
+
+# Connection settings of every provider client: connections kept alive per
+# client or, for openai, per thread (and so TLS sessions reused across calls),
+# and timeouts in seconds. Retries are left to rate_limit.call_with_retry.
+CLIENT_SETTINGS = {"pool_size": 32, "connect_timeout": 10, "read_timeout": 300}
+
+# boto3 sessions are not thread-safe, so clients are created under a lock.
+_aws_lock = threading.RLock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_boto3_session() -> boto3.Session:
+    with _aws_lock:
+        return boto3.Session(region_name=AWS_REGION)
+
+
+def configure_clients(**settings: int) -> None:
+    """Override CLIENT_SETTINGS, e.g. configure_clients(pool_size=64), and
+    have openai build its sessions with them.
+
+    Clients already handed out keep their settings; call this before a run.
+    The pipeline's get_llm_* factories call it when they build their first
+    client.
+    """
+    unknown = settings.keys() - CLIENT_SETTINGS.keys()
+    if unknown:
+        raise ValueError(f"Unknown client settings: {sorted(unknown)}")
+    with _aws_lock:
+        CLIENT_SETTINGS.update(settings)
+        get_bedrock_client.cache_clear()
+        get_bedrock_runtime_client.cache_clear()
+        openai.requestssession = make_openai_session
+
+
+def _botocore_config() -> Config:
+    return Config(
+        max_pool_connections=CLIENT_SETTINGS["pool_size"],
+        connect_timeout=CLIENT_SETTINGS["connect_timeout"],
+        read_timeout=CLIENT_SETTINGS["read_timeout"],
+        tcp_keepalive=True,
+        retries={"total_max_attempts": 1, "mode": "standard"},
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_bedrock_client():
+    with _aws_lock:
+        return get_boto3_session().client(
+            service_name="bedrock", config=_botocore_config()
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_bedrock_runtime_client():
+    # boto3 clients are thread-safe once created; all workers share this one.
+    with _aws_lock:
+        return get_boto3_session().client(
+            service_name="bedrock-runtime", config=_botocore_config()
+        )
+
+
+def make_openai_session() -> requests.Session:
+    # openai calls this once per thread and again when it closes the thread's
+    # session (every MAX_SESSION_LIFETIME_SECS), so each thread keeps its own
+    # pool of warm connections and closing one never affects another thread.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=CLIENT_SETTINGS["pool_size"], max_retries=0
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def _use_openai_client_settings(values: Dict) -> Dict:
+    if values.get("request_timeout") is None:
+        values["request_timeout"] = (
+            CLIENT_SETTINGS["connect_timeout"],
+            CLIENT_SETTINGS["read_timeout"],
+        )
+    return values
+
+
+def _in_slot(provider: str, func):
+    # Holds a request slot of `provider` for one attempt at a time, so that
+    # call_with_retry's backoff sleeps leave the slot to other workers.
+    def attempt():
+        with provider_slot(provider):
+            return func()
+
+    return attempt
+
+
+def _iter_stream_events(response) -> Iterator[dict]:
+    # The decoded chunks of a response stream: {"completion": ..., "stop_reason":
+    # ...}, where the last one has the stop_reason ("stop_sequence" when one of
+    # the stop markers ended the generation). LLMInputOutputAdapter's
+    # prepare_output_stream only yields the text.
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk:
+            yield json.loads(chunk.get("bytes").decode())
+
+
+class NewBedrock(Bedrock):
+    # Default stop markers for calls that do not pass `stop` themselves, since
+    # StuffDocumentsChain does not forward a "stop" input to its LLMChain.
+    stop_markers: List[str] = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @root_validator(pre=True)
+    def use_shared_client(cls, values: Dict) -> Dict:
+        # Reuse one bedrock-runtime client instead of building one per instance.
+        if values.get("client") is None:
+            values["client"] = get_bedrock_runtime_client()
+        return values
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        # LLM's empty params otherwise shadow BedrockBase's, leaving the model
+        # and its kwargs out of LLM cache keys and artifact fingerprints.
+        return {
+            "model_id": self.model_id,
+            "model_kwargs": self.model_kwargs or {},
+            "streaming": self.streaming,
+            "stop_markers": self.stop_markers,
+        }
+
+    def _prepare_input_and_invoke_stream(
+        self, prompt, stop=None, run_manager=None, **kwargs
+    ) -> Iterator[GenerationChunk]:
+        # Streams with invoke_model_with_response_stream; Bedrock stops the
+        # generation at the first of the `stop` markers (e.g. "</summary>") and
+        # leaves the marker out of the text.
+        # Chunks are emitted as they arrive. A stream failing before its first
+        # chunk is retried like a failed invoke; one failing later raises, as
+        # its text has already been emitted.
+        stop = stop or self.stop_markers
+        _model_kwargs = {
+            "prompt": Any,
+            "max_tokens_to_sample": 8192,
+            "temperature": 0.0,
+        }
+        provider = "anthropic"
+        model_kwargs = {**_model_kwargs, **(self.model_kwargs or {}), **kwargs}
+        if stop:
+            model_kwargs["stop_sequences"] = [HUMAN_PROMPT, *stop]
+        input_body = LLMInputOutputAdapter.prepare_input(provider, prompt, model_kwargs)
+        body = json.dumps(input_body)
+        invoke = functools.partial(
+            self.client.invoke_model_with_response_stream,
+            body=body,
+            modelId="anthropic.claude-v2",
+            accept="application/json",
+            contentType="application/json",
+        )
+        prompt_tokens = count_tokens(prompt)
+
+        def open_stream():
+            # Holds the request slot until the stream is closed, not only for
+            # the attempt as _in_slot does.
+            stack = contextlib.ExitStack()
+            stack.enter_context(provider_slot("bedrock"))
+            try:
+                start = time.monotonic()
+                response = invoke()
+                stack.callback(response["body"].close)
+                events = _iter_stream_events(response)
+                first = next(events, None)
+            except BaseException:
+                stack.close()
+                metrics.record_llm_call(self.model_id, prompt_tokens, 0)
+                raise
+            return stack, events, first, time.monotonic() - start
+
+        try:
+            stack, events, first, first_token_s = call_with_retry(
+                "bedrock", open_stream, prompt_tokens
+            )
+        except Exception as e:
+            raise ValueError(f"Error raised by bedrock service: {e}")
+        stop_reason = None
+        generated = 0
+        with stack:  # closing the body abandons the rest of the generation
+            try:
+                for event in itertools.chain([first] if first else [], events):
+                    stop_reason = event.get("stop_reason") or stop_reason
+                    text = event.get("completion", "")
+                    if text:
+                        generated += count_tokens(text)
+                        yield self._emit(text, run_manager)
+            except Exception as e:
+                raise ValueError(f"Error raised by bedrock service: {e}")
+            finally:
+                get_rate_limiter("bedrock").record_tokens(generated)
+                metrics.record_llm_call(self.model_id, prompt_tokens, generated)
+                metrics.record(
+                    time_to_first_token_s=first_token_s,
+                    stopped_early=int(stop_reason == "stop_sequence"),
+                )
+
+    @staticmethod
+    def _emit(text: str, run_manager) -> GenerationChunk:
+        chunk = GenerationChunk(text=text)
+        if run_manager is not None:
+            run_manager.on_llm_new_token(text, chunk=chunk)
+        return chunk
+
+    def _prepare_input_and_invoke(self, prompt, stop=None, run_manager=None, **kwargs):
+        _model_kwargs = {
+            "prompt": Any,
+            "max_tokens_to_sample": 8192,
+            "temperature": 0.2,
+        }
+        provider = "anthropic"
+        model_kwargs = {**_model_kwargs, **(self.model_kwargs or {}), **kwargs}
+        input_body = LLMInputOutputAdapter.prepare_input(provider, prompt, model_kwargs)
+        body = json.dumps(input_body)
+        invoke = functools.partial(
+            self.client.invoke_model,
+            body=body,
+            modelId="anthropic.claude-v2",
+            accept="application/json",
+            contentType="application/json",
+        )
+        prompt_tokens = count_tokens(prompt)
+        try:
+            response = call_with_retry(
+                "bedrock", _in_slot("bedrock", invoke), prompt_tokens
+            )
+            text = LLMInputOutputAdapter.prepare_output(provider, response)
+
+        except Exception as e:
+            raise ValueError(f"Error raised by bedrock service: {e}")
+
+        generated = count_tokens(text)
+        get_rate_limiter("bedrock").record_tokens(generated)
+        metrics.record_llm_call(self.model_id, prompt_tokens, generated)
+        return text
+
+
+def _generate_with_retry(llm, generate, messages, *args, **kwargs):
+    # Chat models retry through rate_limit instead of langchain's own retries
+    # (max_retries=1 on the classes below), so throttles also slow the limiter.
+    prompt_tokens = count_tokens("\n".join(str(m.content) for m in messages))
+    result = call_with_retry(
+        llm.provider,
+        _in_slot(llm.provider, functools.partial(generate, messages, *args, **kwargs)),
+        prompt_tokens,
+    )
+    llm_output = result.llm_output or {}
+    usage = llm_output.get("token_usage", {})
+    completion_tokens = usage.get("completion_tokens", 0)
+    get_rate_limiter(llm.provider).record_tokens(completion_tokens)
+    metrics.record_llm_call(
+        llm_output.get("model_name", llm.model_name),
+        usage.get("prompt_tokens", prompt_tokens),
+        completion_tokens,
+    )
+    return result
+
+
+class NewChatOpenAI(ChatOpenAI):
+    provider: str = "openai"
+    max_retries: int = 1
+
+    @root_validator(pre=True)
+    def use_client_settings(cls, values: Dict) -> Dict:
+        return _use_openai_client_settings(values)
+
+    def _generate(self, messages, *args, **kwargs):
+        return _generate_with_retry(self, super()._generate, messages, *args, **kwargs)
+
+
+class NewAzureChatOpenAI(AzureChatOpenAI):
+    provider: str = "azure"
+    max_retries: int = 1
+
+    @root_validator(pre=True)
+    def use_client_settings(cls, values: Dict) -> Dict:
+        return _use_openai_client_settings(values)
+
+    def _generate(self, messages, *args, **kwargs):
+        return _generate_with_retry(self, super()._generate, messages, *args, **kwargs)
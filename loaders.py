@@ -0,0 +1,585 @@
+import hashlib
+import itertools
+import os
+import pickle
+import posixpath
+import re
+import tempfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from xml.etree import ElementTree
+
+import pypdf
+from langchain.schema.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+import metrics
+from utils import file_digest
+
+# Part of every document cache key: bump when extraction changes in a way that
+# should invalidate previously parsed pages.
+LOADER_VERSION = f"pypdf-{pypdf.__version__}/1"
+
+# PDFs longer than this are split into page ranges extracted by different
+# processes.
+PAGES_PER_TASK = 32
+
+# Page ranges of a streamed file (see iter_documents) submitted to the pool
+# ahead of the page being read. Ranges past the reading limits are never
+# extracted.
+RANGES_IN_FLIGHT = 2
+
+# Spreadsheet rows grouped into one page of an .xlsx file.
+ROWS_PER_PAGE = 50
+
+Page = Tuple[str, dict]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+# Extractions in progress, keyed on (sha256, extractor version). Results
+# evaluated concurrently that share an evidence file (the same CGSpace PDF under
+# several result folders) wait for one extraction and share its pages.
+_inflight: Dict[Tuple[str, str], Future] = {}
+_inflight_lock = threading.Lock()
+
+
+class Extractor(NamedTuple):
+    """Text extraction for one file type.
+
+    `iter_pages(path, start, stop)` lazily yields the (text, metadata) pages
+    numbered start to stop; every page's metadata has its 0-based "page".
+    `page_count(path)`, when set, lets long files be split into page ranges
+    extracted by different processes. `version` is part of the cache key of
+    the extracted pages.
+    """
+
+    version: str
+    iter_pages: Callable[..., Iterator[Page]]
+    page_count: Optional[Callable[[str], int]] = None
+
+
+_EXTRACTORS: Dict[str, Extractor] = {}
+
+
+def register_extractor(
+    *extensions: str, version: str, page_count: Optional[Callable] = None
+):
+    """Decorator registering `iter_pages(path, start=0, stop=None)` for files
+    with the given extensions (e.g. ".pdf")."""
+
+    def decorator(iter_pages):
+        for extension in extensions:
+            _EXTRACTORS[extension.lower()] = Extractor(version, iter_pages, page_count)
+        return iter_pages
+
+    return decorator
+
+
+def get_extractor(path: str) -> Extractor:
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        return _EXTRACTORS[extension]
+    except KeyError:
+        raise ValueError(
+            f"No extractor for {extension or 'extensionless'} files"
+        ) from None
+
+
+class DocumentCache:
+    """On-disk cache of extracted pages keyed on file content and loader version.
+
+    Each entry is a single pickle of (page_content, metadata) tuples, written
+    atomically, so a hit costs one sequential read and no PDF parsing.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _path(self, digest: str, version: str) -> str:
+        key = hashlib.sha256(f"{version}:{digest}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pkl")
+
+    def get(self, digest: str, version: str = LOADER_VERSION) -> Optional[List[Page]]:
+        try:
+            with open(self._path(digest, version), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            return None  # corrupt or incompatible entry, parse again
+
+    def put(self, digest: str, pages: List[Page], version: str = LOADER_VERSION):
+        path = self._path(digest, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(pages, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def start_process_pool(max_workers: Optional[int]) -> Optional[ProcessPoolExecutor]:
+    """Return the process pool shared by every caller, creating it if needed.
+
+    Returns None when max_workers <= 1, in which case files are extracted on the
+    calling thread. The worker processes are started right away: call this from
+    the main thread before starting other threads, so they are not forked while
+    those threads hold locks.
+    """
+    global _pool
+    if not max_workers or max_workers <= 1:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=max_workers)
+            _pool.submit(int).result()
+        return _pool
+
+
+def shutdown_process_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+# Extractors
+
+
+def _pdf_page_count(path: str) -> int:
+    return len(pypdf.PdfReader(path).pages)
+
+
+@register_extractor(".pdf", version=LOADER_VERSION, page_count=_pdf_page_count)
+def iter_pdf_pages(path: str, start: int = 0, stop: Optional[int] = None):
+    # Mirrors PyPDFLoader: one entry per page, numbered from 0.
+    reader = pypdf.PdfReader(path)
+    for page_number, page in enumerate(reader.pages[start:stop], start=start):
+        yield page.extract_text(), {"page": page_number}
+
+
+_PPTX_NS = {
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+
+
+def _pptx_slide_names(pptx: zipfile.ZipFile) -> List[str]:
+    # Slides in presentation order (presentation.xml), falling back to the
+    # numbers in their file names.
+    names = set(pptx.namelist())
+    try:
+        presentation = ElementTree.fromstring(pptx.read("ppt/presentation.xml"))
+        rels = ElementTree.fromstring(pptx.read("ppt/_rels/presentation.xml.rels"))
+    except KeyError:
+        presentation = rels = None
+    if presentation is not None:
+        targets = {
+            rel.get("Id"): posixpath.normpath(posixpath.join("ppt", rel.get("Target")))
+            for rel in rels.iterfind("rel:Relationship", _PPTX_NS)
+        }
+        ordered = [
+            targets.get(slide.get(f"{{{_PPTX_NS['r']}}}id"))
+            for slide in presentation.iterfind("p:sldIdLst/p:sldId", _PPTX_NS)
+        ]
+        ordered = [name for name in ordered if name in names]
+        if ordered:
+            return ordered
+
+    slides = [n for n in names if re.fullmatch(r"ppt/slides/slide\d+\.xml", n)]
+    return sorted(slides, key=lambda n: int(re.search(r"(\d+)\.xml$", n).group(1)))
+
+
+@register_extractor(".pptx", version="pptx-xml/1")
+def iter_pptx_pages(path: str, start: int = 0, stop: Optional[int] = None):
+    # One page per slide: the text of each paragraph on its own line, in the
+    # order the shapes appear on the slide.
+    with zipfile.ZipFile(path) as pptx:
+        slide_names = _pptx_slide_names(pptx)[start:stop]
+        for page_number, name in enumerate(slide_names, start=start):
+            slide = ElementTree.fromstring(pptx.read(name))
+            lines = []
+            for paragraph in slide.iter(f"{{{_PPTX_NS['a']}}}p"):
+                text = "".join(
+                    node.text or "" for node in paragraph.iter(f"{{{_PPTX_NS['a']}}}t")
+                )
+                if text.strip():
+                    lines.append(text)
+            yield "\n".join(lines), {"page": page_number, "slide": page_number + 1}
+
+
+@register_extractor(".xlsx", ".xlsm", version=f"openpyxl-{ROWS_PER_PAGE}/1")
+def iter_xlsx_pages(path: str, start: int = 0, stop: Optional[int] = None):
+    # Rows are streamed in read-only mode and emitted ROWS_PER_PAGE at a time,
+    # tab separated, one page per block of rows of each sheet.
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        pages = _iter_sheet_pages(workbook)
+        for page_number, (text, metadata) in enumerate(
+            itertools.islice(pages, start, stop), start=start
+        ):
+            yield text, {"page": page_number, **metadata}
+    finally:
+        workbook.close()
+
+
+def _iter_sheet_pages(workbook) -> Iterator[Page]:
+    for sheet in workbook.worksheets:
+        lines, first_row = [], 1
+        for row_number, row in enumerate(sheet.iter_rows(values_only=True), 1):
+            cells = ["" if value is None else str(value) for value in row]
+            if any(cells):
+                lines.append("\t".join(cells).rstrip("\t"))
+            if row_number % ROWS_PER_PAGE == 0:
+                if lines:
+                    yield "\n".join(lines), _rows(sheet.title, first_row, row_number)
+                lines, first_row = [], row_number + 1
+        if lines:
+            yield "\n".join(lines), _rows(sheet.title, first_row, row_number)
+
+
+def _rows(sheet: str, first_row: int, last_row: int) -> dict:
+    return {"sheet": sheet, "rows": f"{first_row}-{last_row}"}
+
+
+# Loading
+
+
+def _extract_page_range(path: str, start: int, stop: Optional[int]) -> List[Page]:
+    return list(get_extractor(path).iter_pages(path, start, stop))
+
+
+def _page_ranges(path: str) -> List[Tuple[int, Optional[int]]]:
+    extractor = get_extractor(path)
+    if extractor.page_count is None:
+        return [(0, None)]
+    num_pages = extractor.page_count(path)
+    return [
+        (start, min(start + PAGES_PER_TASK, num_pages))
+        for start in range(0, max(num_pages, 1), PAGES_PER_TASK)
+    ]
+
+
+def _submit_extraction(pool: ProcessPoolExecutor, path: str) -> List[Future]:
+    return [
+        pool.submit(_extract_page_range, path, start, stop)
+        for start, stop in _page_ranges(path)
+    ]
+
+
+def _iter_extraction(pool: ProcessPoolExecutor, path: str) -> Iterator[Page]:
+    # Like _submit_extraction, but with only RANGES_IN_FLIGHT ranges submitted
+    # at a time; the ranges still pending are cancelled when the reader stops.
+    ranges = iter(_page_ranges(path))
+    in_flight = deque(
+        pool.submit(_extract_page_range, path, start, stop)
+        for start, stop in itertools.islice(ranges, RANGES_IN_FLIGHT)
+    )
+    try:
+        while in_flight:
+            pages = in_flight.popleft().result()
+            for start, stop in itertools.islice(ranges, 1):
+                in_flight.append(pool.submit(_extract_page_range, path, start, stop))
+            yield from pages
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def extract_pages(path: str, pool: Optional[ProcessPoolExecutor] = None) -> List[Page]:
+    if pool is None:
+        return _extract_page_range(path, 0, None)
+    return [page for f in _submit_extraction(pool, path) for page in f.result()]
+
+
+def _to_documents(path: str, pages: List[Page]) -> List[Document]:
+    docs = [
+        Document(page_content=text, metadata={"source": path, **metadata})
+        for text, metadata in pages
+    ]
+    return RecursiveCharacterTextSplitter().split_documents(docs)
+
+
+def load_documents(
+    paths: Sequence[str],
+    cache: Optional[DocumentCache] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+    digests: Optional[Sequence[Optional[str]]] = None,
+    skip_unreadable: bool = False,
+) -> List[Optional[List[Document]]]:
+    """Load several files with the extractor registered for each file type,
+    returning documents split like PyPDFLoader(path).load_and_split().
+
+    Cache misses are all submitted to `pool` before waiting on any of them, so
+    files (and page ranges of long files) are extracted in parallel. Pages are
+    reassembled in their original order. Known sha256 `digests` (e.g. from the
+    corpus manifest) spare hashing the files again; with a `cache`, content
+    that another caller is extracting at the same time is waited for instead of
+    being extracted twice. With `skip_unreadable`, a
+    file of an unsupported type or that fails to parse is reported and comes
+    back as None instead of raising.
+    """
+    digests = list(digests) if digests is not None else [None] * len(paths)
+    if cache is not None:
+        digests = [d or file_digest(path) for d, path in zip(digests, paths)]
+    pages: List[Optional[List[Page]]] = [None] * len(paths)
+    versions: Dict[int, str] = {}
+    errors: Dict[int, Exception] = {}
+    for i, path in enumerate(paths):
+        try:
+            versions[i] = get_extractor(path).version
+        except ValueError as e:
+            errors[i] = e
+            continue
+        if cache is not None:
+            pages[i] = cache.get(digests[i], versions[i])
+
+    misses = [i for i, _pages in enumerate(pages) if _pages is None and i not in errors]
+    # Files already being extracted by another caller are waited for, once this
+    # call's own extractions are done, so callers never wait on each other.
+    claimed: Dict[int, Future] = {}
+    waiting: Dict[int, Future] = {}
+    if cache is not None:
+        with _inflight_lock:
+            for i in misses:
+                key = (digests[i], versions[i])
+                if key in _inflight:
+                    waiting[i] = _inflight[key]
+                else:
+                    claimed[i] = _inflight[key] = Future()
+        misses = [i for i in misses if i not in waiting]
+
+    try:
+        pending = {}
+        for i in misses:
+            try:
+                if pool is None:
+                    pages[i] = extract_pages(paths[i])
+                else:
+                    pending[i] = _submit_extraction(pool, paths[i])
+            except Exception as e:
+                errors[i] = e
+        for i, futures in pending.items():
+            try:
+                pages[i] = [page for f in futures for page in f.result()]
+            except Exception as e:
+                errors[i] = e
+        if cache is not None:
+            for i in misses:
+                if i not in errors:
+                    cache.put(digests[i], pages[i], versions[i])
+    finally:
+        with _inflight_lock:
+            for i, future in claimed.items():
+                del _inflight[(digests[i], versions[i])]
+                if i in errors:
+                    future.set_exception(errors[i])
+                elif pages[i] is None:
+                    future.set_exception(RuntimeError("Extraction interrupted"))
+                else:
+                    future.set_result(pages[i])
+    for i, future in waiting.items():
+        try:
+            pages[i] = future.result()
+            if pages[i] is None:  # a stream stopped reading the file early
+                pages[i] = extract_pages(paths[i], pool)
+                cache.put(digests[i], pages[i], versions[i])
+        except Exception as e:
+            errors[i] = e
+
+    if errors and not skip_unreadable:
+        raise errors[min(errors)]
+    for i, error in sorted(errors.items()):
+        print(f"Skipping unreadable file {paths[i]}: {error!r}")
+
+    return [
+        None if i in errors else _to_documents(path, pages[i])
+        for i, path in enumerate(paths)
+    ]
+
+
+def load_document(
+    path: str,
+    cache: Optional[DocumentCache] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+) -> List[Document]:
+    """Documents of one file, like PyPDFLoader(path).load_and_split() for PDFs,
+    backed by `cache`."""
+    return load_documents([path], cache=cache, pool=pool)[0]
+
+
+def _iter_file_pages(
+    path: str,
+    digest: Optional[str],
+    cache: Optional[DocumentCache],
+    pool: Optional[ProcessPoolExecutor],
+) -> Iterator[Page]:
+    # Pages of one file, from the cache or extracted as they are read. A file
+    # read to the end is added to the cache. With a cache, the extraction is
+    # registered in _inflight like those of load_documents: other readers of
+    # the same content wait for its pages, or extract the file themselves when
+    # this reader stops early (the future then gets None).
+    extractor = get_extractor(path)
+    claimed = None
+    if cache is not None:
+        key = (digest, extractor.version)
+        cached = cache.get(*key)
+        if cached is None:
+            with _inflight_lock:
+                other = _inflight.get(key)
+                if other is None:
+                    claimed = _inflight[key] = Future()
+            if other is not None:
+                cached = other.result()
+        if cached is not None:
+            yield from cached
+            return
+
+    if pool is None:
+        pages = extractor.iter_pages(path)
+    else:
+        pages = _iter_extraction(pool, path)
+    seen = [] if cache is not None else None
+    complete = False
+    error = None
+    try:
+        for page in pages:
+            if seen is not None:
+                seen.append(page)
+            yield page
+        complete = True
+        if seen is not None:
+            cache.put(digest, seen, extractor.version)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if hasattr(pages, "close"):
+            pages.close()  # cancels the page ranges not extracted yet
+        if claimed is not None:
+            with _inflight_lock:
+                del _inflight[key]
+            if error is not None:
+                claimed.set_exception(error)
+            else:
+                claimed.set_result(seen if complete else None)
+
+
+def iter_documents(
+    paths: Sequence[str],
+    cache: Optional[DocumentCache] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+    digests: Optional[Sequence[Optional[str]]] = None,
+    skip_unreadable: bool = False,
+    max_pages: Optional[int] = None,
+    max_chars: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    record: bool = True,
+) -> Iterator[Document]:
+    """Lazily yield the documents of `paths`, file by file and page by page.
+
+    Same documents as load_documents, but only the pages of the file being read
+    are held in memory. Reading stops after `max_pages` pages or `max_chars`
+    characters (the last page is cut), and no further file is opened once
+    `max_bytes` bytes of files have been read. With `record`, the files, bytes
+    and pages read are recorded in the current metrics stage as they are read.
+    """
+    splitter = RecursiveCharacterTextSplitter()
+    digests = list(digests) if digests is not None else [None] * len(paths)
+    pages_read = chars_read = bytes_read = 0
+    for path, digest in zip(paths, digests):
+        if max_bytes is not None and bytes_read >= max_bytes:
+            print(f"Stopped reading evidence at {bytes_read} bytes ({path} not read)")
+            return
+        try:
+            size = os.path.getsize(path)
+            if cache is not None:
+                digest = digest or file_digest(path)
+            pages = _iter_file_pages(path, digest, cache, pool)
+            page = next(pages, None)
+        except Exception as e:
+            if not skip_unreadable:
+                raise
+            print(f"Skipping unreadable file {path}: {e!r}")
+            continue
+        bytes_read += size
+        if record:
+            metrics.record(files=1, bytes=size)
+
+        # Closing the file's pages as soon as a limit is hit (or the reader
+        # stops) cancels the extraction of the pages past it.
+        try:
+            while page is not None:
+                text, metadata = page
+                if max_chars is not None and chars_read + len(text) > max_chars:
+                    text = text[: max_chars - chars_read]
+                pages_read += 1
+                if record:
+                    metrics.record(pages=1)
+                chars_read += len(text)
+                doc = Document(page_content=text, metadata={"source": path, **metadata})
+                yield from splitter.split_documents([doc])
+
+                if max_pages is not None and pages_read >= max_pages:
+                    print(f"Stopped reading evidence at {pages_read} pages")
+                    return
+                if max_chars is not None and chars_read >= max_chars:
+                    print(f"Stopped reading evidence at {chars_read} characters")
+                    return
+                try:
+                    page = next(pages, None)
+                except Exception as e:
+                    if not skip_unreadable:
+                        raise
+                    print(f"Skipping the rest of unreadable file {path}: {e!r}")
+                    page = None
+        finally:
+            pages.close()
+
+
+class DocumentStream:
+    """Re-iterable iter_documents(paths, **options).
+
+    Every iteration reads the files again (from `cache`, when given), so several
+    passes over the evidence, or several consumers of it, hold no more than one
+    file's pages at a time. Only the first pass is recorded in the metrics.
+    """
+
+    def __init__(self, paths: Sequence[str], **options):
+        self.paths = list(paths)
+        self.options = options
+        self._recorded = False
+
+    def __iter__(self) -> Iterator[Document]:
+        # A generator, so that iter(stream) alone (as in the checks for one-shot
+        # iterators) does not use up the recorded pass.
+        record, self._recorded = not self._recorded, True
+        yield from iter_documents(self.paths, record=record, **self.options)
+
+
+# Names used before other file types were supported.
+load_pdfs = load_documents
+load_pdf = load_document
+extract_pdf_pages = extract_pages
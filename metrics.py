@@ -0,0 +1,377 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# USD per 1,000 prompt and completion tokens, used to estimate the cost of each
+# stage. Models missing here are counted with a cost of 0.
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-35-turbo": (0.0015, 0.002),
+    "anthropic.claude-v2": (0.008, 0.024),
+}
+
+# Counters kept per stage, on top of its wall time.
+COUNTERS = (
+    "llm_calls",
+    "input_tokens",
+    "output_tokens",
+    "retries",
+    "files",
+    "bytes",
+    "pages",
+    "cost_usd",
+    "tokens_saved",
+    "duplicate_tokens",
+    "escalations",
+    "tokens_dropped",
+    "time_to_first_token_s",
+    "stopped_early",
+)
+
+_local = threading.local()
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+
+class ResultMetrics:
+    """Wall time and counters of each pipeline stage of one result.
+
+    Stages nest: a stage's wall time excludes the stages run inside it (e.g.
+    loading the PDFs on the first call from the extraction stage), so the
+    stage times add up to the time spent on the result.
+    """
+
+    def __init__(self, result_id, task: Optional[str] = None):
+        self.result_id = result_id
+        self.task = task
+        self.stages: Dict[str, dict] = {}
+        self.wall_s: Optional[float] = None
+        self._stack: List[list] = []  # [stage name, time spent in nested stages]
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _stage(self, name: str) -> dict:
+        if name not in self.stages:
+            self.stages[name] = {"wall_s": 0.0, **{key: 0 for key in COUNTERS}}
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        stats = self._stage(name)
+        frame = [name, 0.0]
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            stats["wall_s"] += elapsed - frame[1]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def current_stage(self) -> str:
+        return self._stack[-1][0] if self._stack else "other"
+
+    def add(self, **counts) -> None:
+        """Add `counts` to the innermost running stage (or to "other")."""
+        self.add_to(self.current_stage(), **counts)
+
+    def add_to(self, stage: str, **counts) -> None:
+        with self._lock:
+            stats = self._stage(stage)
+            for key, value in counts.items():
+                stats[key] = stats.get(key, 0) + value
+
+    def merge(self, other: "ResultMetrics") -> None:
+        for name, other_stats in other.stages.items():
+            stats = self._stage(name)
+            for key, value in other_stats.items():
+                stats[key] = stats.get(key, 0) + value
+
+    def finish(self) -> None:
+        self.wall_s = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        stages = {name: dict(stats) for name, stats in self.stages.items()}
+        total = {
+            key: sum(stats.get(key, 0) for stats in stages.values())
+            for key in ("wall_s", *COUNTERS)
+        }
+        if self.wall_s is not None:
+            total["wall_s"] = self.wall_s
+        return {"stages": stages, "total": total}
+
+    def to_record(self) -> dict:
+        return {
+            "result_id": self.result_id,
+            "task": self.task,
+            "timestamp": time.time(),
+            **self.to_dict(),
+        }
+
+
+def current() -> Optional[ResultMetrics]:
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def record(**counts) -> None:
+    """Add counts (tokens, retries, bytes, ...) to the calling thread's current
+    stage; a no-op outside of `track`."""
+    metrics = current()
+    if metrics is not None:
+        metrics.add(**counts)
+
+
+def record_llm_call(model: str, input_tokens: int, output_tokens: int) -> None:
+    record(
+        llm_calls=1,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cost_usd=estimate_cost(model, input_tokens, output_tokens),
+    )
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time `name` as a stage of the calling thread's current result."""
+    metrics = current()
+    if metrics is None or isinstance(metrics, _BoundStage):
+        yield
+        return
+    with metrics.stage(name):
+        yield
+
+
+class _BoundStage:
+    # Stands in for a result's metrics on another thread: counts go to the
+    # stage that was running when the function was bound.
+    def __init__(self, metrics: ResultMetrics, stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def add(self, **counts) -> None:
+        self.metrics.add_to(self.stage, **counts)
+
+
+def bind(func):
+    """Wrap `func` so that, called on another thread (e.g. a map over
+    batches), it records into the calling thread's current result and stage."""
+    metrics = current()
+    if metrics is None:
+        return func
+    if isinstance(metrics, _BoundStage):
+        bound = metrics
+    else:
+        bound = _BoundStage(metrics, metrics.current_stage())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(bound)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def track(result_id, task: Optional[str] = None) -> Iterator[ResultMetrics]:
+    """Collect the metrics of one result on the calling thread.
+
+    The metrics are sent to the installed sinks when the block exits, whether
+    or not it raised. Blocks may nest (run_tasks.py tracks the shared stages
+    around each task's own block); each keeps its own stages.
+    """
+    metrics = ResultMetrics(result_id, task)
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(metrics)
+    try:
+        yield metrics
+    finally:
+        stack.pop()
+        metrics.finish()
+        emit(metrics)
+
+
+# Sinks
+
+
+class JsonlMetricsSink:
+    """Appends one JSON line per result to `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.target = ("jsonl", path)
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def emit(self, metrics: ResultMetrics) -> None:
+        line = json.dumps(metrics.to_record(), default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class PrometheusMetricsSink:
+    """Serves running totals per task and stage in the Prometheus text format
+    on http://<host>:<port>/metrics."""
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self.target = ("prometheus", port)
+        self._lock = threading.Lock()
+        self._results: Dict[str, int] = {}
+        self._totals: Dict[tuple, Dict[str, float]] = {}
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def emit(self, metrics: ResultMetrics) -> None:
+        task = metrics.task or ""
+        with self._lock:
+            self._results[task] = self._results.get(task, 0) + 1
+            for name, stats in metrics.stages.items():
+                totals = self._totals.setdefault((task, name), {})
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
+
+    def render(self) -> str:
+        with self._lock:
+            results = sorted(self._results.items())
+            totals = sorted(self._totals.items())
+        lines = ["# TYPE qa_results_total counter"]
+        for task, count in results:
+            lines.append(f'qa_results_total{{task="{task}"}} {count}')
+        for key in ("wall_s", *COUNTERS):
+            if key == "wall_s":
+                metric = "qa_stage_seconds_total"
+            else:
+                metric = f"qa_stage_{key}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (task, name), stats in totals:
+                labels = f'task="{task}",stage="{name}"'
+                lines.append(f"{metric}{{{labels}}} {stats.get(key, 0)}")
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_sinks: List = []
+_sinks_lock = threading.Lock()
+
+
+def add_sink(sink) -> None:
+    """Send every result's metrics to `sink.emit(metrics)`."""
+    with _sinks_lock:
+        _sinks.append(sink)
+
+
+def install_sinks(path: Optional[str] = None, port: Optional[int] = None) -> None:
+    """Send per-result metrics to a JSON lines file and/or a Prometheus endpoint.
+
+    A sink for the same file or port is only installed once.
+    """
+    with _sinks_lock:
+        installed = {getattr(sink, "target", None) for sink in _sinks}
+    if path and ("jsonl", path) not in installed:
+        add_sink(JsonlMetricsSink(path))
+    if port and ("prometheus", port) not in installed:
+        add_sink(PrometheusMetricsSink(port))
+
+
+def emit(metrics: ResultMetrics) -> None:
+    with _sinks_lock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        try:
+            sink.emit(metrics)
+        except Exception as e:
+            print(f"Error: Unable to emit metrics for {metrics.result_id}: {e!r}")
+
+
+# cProfile can only profile one thread at a time, so results are profiled one
+# after the other.
+_profile_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def profile(result_id, result_ids: Iterable, output_dir: Optional[str]):
+    """Profile the block if `result_id` is one of `result_ids`.
+
+    Writes <output_dir>/<result_id>.prof (cProfile stats of the calling thread,
+    for pstats or snakeviz), <result_id>.tracemalloc (a snapshot of the traced
+    memory, for tracemalloc.Snapshot.load) and <result_id>.tracemalloc.txt (the
+    lines that allocated the most during the block, in any thread).
+    """
+    selected = {str(r) for r in result_ids or ()}
+    if not output_dir or str(result_id) not in selected:
+        yield
+        return
+    if not _profile_lock.acquire(blocking=False):
+        print(f"Not profiling result {result_id}: another result is being profiled")
+        yield
+        return
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(25)
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            after = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            base = os.path.join(output_dir, str(result_id))
+            profiler.dump_stats(f"{base}.prof")
+            after.dump(f"{base}.tracemalloc")
+            top = after.compare_to(before, "lineno")[:20]
+            with open(f"{base}.tracemalloc.txt", "w") as f:
+                f.write("".join(f"{stat}\n" for stat in top))
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,334 @@
+import hashlib
+import heapq
+import itertools
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+)
+
+from langchain.schema.document import Document
+
+import metrics
+from packing import count_tokens
+
+# Part of the fingerprint of every stage fed normalized text: bump when the
+# cleanup below changes what reaches the prompts.
+NORMALIZER_VERSION = "3"
+
+# Lines at the top and bottom of each page checked for running headers,
+# footers and page numbers; longer lines are taken to be body text.
+EDGE_LINES = 3
+EDGE_LINE_MAX_CHARS = 120
+
+# An edge line is a running header or footer when it (digits aside) comes back
+# on at least this many pages, and on this share of the pages of the file.
+MIN_REPEATS = 3
+REPEAT_SHARE = 0.3
+
+# A document whose word shingles overlap an earlier document of the same result
+# at least this much (estimated Jaccard similarity) is dropped: a page repeated
+# across evidence files, e.g. the preprint and the published version of a paper.
+NEAR_DUPLICATE_SIMILARITY = 0.8
+SHINGLE_WORDS = 5
+SKETCH_SIZE = 64
+
+# Characters of normalized text kept in a NormalizedCache; the least recently
+# used files are dropped first.
+NORMALIZED_CACHE_MAX_CHARS = 50_000_000
+
+_DIGITS_RE = re.compile(r"\d+")
+_WORD_RE = re.compile(r"\w+")
+_PAGE_NUMBER_RE = re.compile(
+    r"(?:page\s*)?\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?|[-–—]\s*\d{1,4}\s*[-–—]",
+    re.IGNORECASE,
+)
+# A references heading on a line of its own, possibly numbered ("7. References").
+_REFERENCES_RE = re.compile(
+    r"^[ \t]*(?:\d{1,2}\.?[ \t]*)?"
+    r"(?:references|bibliography|reference list|literature cited|works cited"
+    r"|cited literature)[ \t]*:?[ \t]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+# Starts on the hyphen, which is much faster to scan for than a letter.
+_HYPHENATED_RE = re.compile(r"-(?<=[^\W\d_]-)[ \t]*\n[ \t]*(?=[^\W\d_A-Z])")
+_SPACES_RE = re.compile(r"[^\S\n]+")
+_LINE_BREAK_RE = re.compile(r" ?\n ?")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def _line_key(line: str) -> str:
+    return _DIGITS_RE.sub("#", " ".join(line.lower().split()))
+
+
+def _edge_indexes(lines: Sequence[str], top: bool, bottom: bool) -> List[int]:
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    indexes = set()
+    if top:
+        indexes.update(filled[:EDGE_LINES])
+    if bottom:
+        indexes.update(filled[-EDGE_LINES:])
+    return sorted(i for i in indexes if len(lines[i].strip()) <= EDGE_LINE_MAX_CHARS)
+
+
+def _repeated_edge_lines(pages: Sequence[Sequence[Document]]) -> Set[str]:
+    counts: Counter = Counter()
+    for page in pages:
+        keys = set()
+        for position, doc in enumerate(page):
+            lines = doc.page_content.split("\n")
+            top, bottom = position == 0, position == len(page) - 1
+            keys.update(_line_key(lines[i]) for i in _edge_indexes(lines, top, bottom))
+        counts.update(keys)
+    threshold = max(MIN_REPEATS, REPEAT_SHARE * len(pages))
+    return {key for key, count in counts.items() if count >= threshold}
+
+
+def _strip_edges(text: str, repeated: Set[str], top: bool, bottom: bool) -> str:
+    lines = text.split("\n")
+    dropped = {
+        i
+        for i in _edge_indexes(lines, top, bottom)
+        if _line_key(lines[i]) in repeated
+        or _PAGE_NUMBER_RE.fullmatch(lines[i].strip())
+    }
+    if not dropped:
+        return text
+    return "\n".join(line for i, line in enumerate(lines) if i not in dropped)
+
+
+def clean_text(text: str) -> str:
+    """Join words hyphenated across line breaks and collapse whitespace."""
+    text = _HYPHENATED_RE.sub("", text)
+    text = _SPACES_RE.sub(" ", text)
+    text = _LINE_BREAK_RE.sub("\n", text)
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def _shingle_hash(shingle: Sequence[str]) -> int:
+    # A fixed hash, unlike hash() on str, which is salted per process: the
+    # same pages are kept or dropped on every run and in every worker.
+    digest = hashlib.blake2b(" ".join(shingle).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _similarity(a: Sequence[int], b: Sequence[int]) -> float:
+    # Bottom-k estimate of the Jaccard similarity of two shingle sets.
+    shared = set(a) & set(b)
+    union = heapq.nsmallest(SKETCH_SIZE, set(a) | set(b))
+    return sum(h in shared for h in union) / len(union)
+
+
+def _sketch(text: str) -> Optional[List[int]]:
+    # Bottom-k sketch (the SKETCH_SIZE smallest shingle hashes) of `text`, or
+    # None when it is too short to tell a duplicate from a common phrase.
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < 2 * SHINGLE_WORDS:
+        return None
+    shingles = {
+        _shingle_hash(words[i : i + SHINGLE_WORDS])
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+    return heapq.nsmallest(SKETCH_SIZE, shingles)
+
+
+class _NearDuplicates:
+    # Sketches of the documents seen so far, indexed by hash to find
+    # candidates in O(k).
+    def __init__(self):
+        self.sketches: List[List[int]] = []
+        self.index: Dict[int, List[int]] = {}
+
+    def seen(self, sketch: Optional[List[int]]) -> bool:
+        """Whether `sketch` nearly duplicates an earlier one; remembers it if not."""
+        if sketch is None:
+            return False
+        candidates = Counter(j for h in sketch for j in self.index.get(h, ()))
+        for j, shared in candidates.most_common():
+            other = self.sketches[j]
+            if shared < NEAR_DUPLICATE_SIMILARITY * max(len(sketch), len(other)):
+                break  # the estimate cannot reach the threshold from here on
+            if _similarity(sketch, other) >= NEAR_DUPLICATE_SIMILARITY:
+                return True
+
+        for h in sketch:
+            self.index.setdefault(h, []).append(len(self.sketches))
+        self.sketches.append(sketch)
+        return False
+
+
+class _Part(NamedTuple):
+    # A normalized document: the position of the document it comes from among
+    # its file's documents, its text, estimated tokens and sketch.
+    position: int
+    text: str
+    tokens: int
+    sketch: Optional[List[int]]
+
+
+class _NormalizedFile(NamedTuple):
+    parts: List[_Part]
+    tokens_saved: int
+
+
+def _iter_parts(docs: List[Document]) -> Iterator[_Part]:
+    # Running headers, footers, page numbers and reference sections are only
+    # looked for in PDFs; slides and spreadsheets just get their text cleaned.
+    source = docs[0].metadata.get("source") or ""
+    is_pdf = os.path.splitext(source)[1].lower() == ".pdf"
+    pages = [
+        list(page)
+        for _, page in itertools.groupby(docs, key=lambda d: d.metadata.get("page"))
+    ]
+    repeated = _repeated_edge_lines(pages) if is_pdf else set()
+    positions = itertools.count()
+    for index, page in enumerate(pages):
+        for page_position, doc in enumerate(page):
+            position = next(positions)
+            text = doc.page_content
+            references = None
+            if is_pdf:
+                top, bottom = page_position == 0, page_position == len(page) - 1
+                text = _strip_edges(text, repeated, top, bottom)
+                # A heading in the first half is more likely a table of contents.
+                if 2 * index >= len(pages):
+                    references = _REFERENCES_RE.search(text)
+                    if references:
+                        text = text[: references.start()]
+            text = clean_text(text)
+            if text:
+                yield _Part(position, text, count_tokens(text), _sketch(text))
+            if references:
+                return  # the rest of the file is the bibliography
+
+
+def _normalize_file(docs: List[Document]) -> _NormalizedFile:
+    parts = list(_iter_parts(docs))
+    tokens_saved = sum(count_tokens(doc.page_content) for doc in docs) - sum(
+        part.tokens for part in parts
+    )
+    return _NormalizedFile(parts, tokens_saved)
+
+
+class NormalizedCache:
+    """Normalized documents of files, with their near-duplicate sketches, keyed
+    on the files' sha256 (see corpus.Corpus.file_digest).
+
+    One cache is shared by every result of a corpus, so a file that several
+    results cite, or that several stages and tasks read, is normalized and
+    shingled once. Only the check for near duplicates, which is limited to the
+    files of one result, runs again for each result.
+    """
+
+    def __init__(self, max_chars: int = NORMALIZED_CACHE_MAX_CHARS):
+        self.max_chars = max_chars
+        self._files: "OrderedDict[tuple, _NormalizedFile]" = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def normalize(self, docs: List[Document], digest: str) -> _NormalizedFile:
+        # Keyed on the documents read too, as a file can be cut short by the
+        # evidence limits (see loaders.iter_documents).
+        key = (digest, len(docs), sum(len(doc.page_content) for doc in docs))
+        with self._lock:
+            normalized = self._files.get(key)
+            if normalized is not None:
+                self._files.move_to_end(key)
+                return normalized
+
+        normalized = _normalize_file(docs)
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = normalized
+                self._chars += _chars(normalized)
+            while self._chars > self.max_chars and len(self._files) > 1:
+                _, dropped = self._files.popitem(last=False)
+                self._chars -= _chars(dropped)
+        return normalized
+
+
+def _chars(normalized: _NormalizedFile) -> int:
+    return sum(len(part.text) for part in normalized.parts)
+
+
+def _iter_normalized(
+    docs: Iterable[Document],
+    record: bool,
+    digests: Mapping[str, str],
+    cache: Optional[NormalizedCache],
+) -> Iterator[Document]:
+    # Files are normalized one at a time, as they come out of `docs`.
+    near_duplicates = _NearDuplicates()
+    for source, group in itertools.groupby(
+        docs, key=lambda d: d.metadata.get("source")
+    ):
+        file_docs = list(group)
+        digest = digests.get(source)
+        if cache is not None and digest is not None:
+            normalized = cache.normalize(file_docs, digest)
+        else:
+            normalized = _normalize_file(file_docs)
+        duplicate = 0
+        for part in normalized.parts:
+            if near_duplicates.seen(part.sketch):
+                duplicate += part.tokens
+                continue
+            metadata = file_docs[part.position].metadata
+            yield Document(page_content=part.text, metadata=metadata)
+        if record:
+            metrics.record(
+                tokens_saved=normalized.tokens_saved, duplicate_tokens=duplicate
+            )
+
+
+class _NormalizedStream:
+    def __init__(self, docs: Iterable[Document], **options):
+        self.docs = docs
+        self.options = options
+        self._recorded = False
+
+    def __iter__(self) -> Iterator[Document]:
+        # A generator, so that iter(stream) alone (as in the checks for one-shot
+        # iterators) does not use up the recorded pass.
+        record, self._recorded = not self._recorded, True
+        yield from _iter_normalized(self.docs, record, **self.options)
+
+
+def normalize_documents(
+    docs: Iterable[Document],
+    digests: Optional[Mapping[str, str]] = None,
+    cache: Optional[NormalizedCache] = None,
+) -> Iterable[Document]:
+    """Strip the text of `docs` of what is not worth prompting with.
+
+    Per file: running headers and footers (edge lines repeated across pages)
+    and page numbers are removed, the text from a references/bibliography
+    heading onwards is cut, words hyphenated across lines are joined and
+    whitespace is collapsed. Documents that nearly duplicate an earlier one
+    (by shingled hashes) are then dropped. The estimated tokens saved are
+    recorded as the "tokens_saved" and "duplicate_tokens" metrics of the
+    current stage.
+
+    With a `cache`, the files whose sha256 is in `digests` (keyed on the
+    documents' "source") are normalized once and then taken from the cache.
+
+    A list gives a list. Any other iterable is taken to be a re-iterable
+    stream (e.g. loaders.DocumentStream) and is normalized as it is read; only
+    its first pass is recorded. One-shot iterators stay one-shot.
+    """
+    options = {"digests": digests or {}, "cache": cache}
+    if isinstance(docs, list):
+        return list(_iter_normalized(docs, record=True, **options))
+    if iter(docs) is docs:
+        return _iter_normalized(docs, record=True, **options)
+    return _NormalizedStream(docs, **options)
@@ -0,0 +1,150 @@
+import itertools
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List
+
+from langchain.schema.document import Document
+
+import metrics
+
+# Words and punctuation marks; long words count as several tokens. This tracks
+# the Claude/GPT BPE tokenizers closely enough for budgeting, without loading a
+# tokenizer or calling the network.
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_CHARS_PER_WORD_TOKEN = 6
+
+
+def count_tokens(text: str) -> int:
+    return sum(
+        1 + len(piece) // _CHARS_PER_WORD_TOKEN for piece in _TOKEN_RE.findall(text)
+    )
+
+
+def _split_document(
+    doc: Document, budget: int, count: Callable[[str], int]
+) -> List[Document]:
+    # Halve a document larger than the whole budget until every part fits.
+    text = doc.page_content
+    if count(text) <= budget or len(text) < 2:
+        return [doc]
+    middle = len(text) // 2
+    return [
+        part
+        for half in (text[:middle], text[middle:])
+        for part in _split_document(
+            Document(page_content=half, metadata=doc.metadata), budget, count
+        )
+    ]
+
+
+def iter_batches(
+    docs: Iterable[Document], budget: int, count: Callable[[str], int] = count_tokens
+) -> Iterator[List[Document]]:
+    """Group docs, in order, into batches of at most `budget` tokens each,
+    yielding every batch as soon as it is full."""
+    batch: List[Document] = []
+    used = 0
+    for doc in docs:
+        for part in _split_document(doc, budget, count):
+            tokens = count(part.page_content)
+            if batch and used + tokens > budget:
+                yield batch
+                batch, used = [], 0
+            batch.append(part)
+            used += tokens
+
+    if batch:
+        yield batch
+
+
+def pack_documents(
+    docs: Iterable[Document], budget: int, count: Callable[[str], int] = count_tokens
+) -> List[List[Document]]:
+    """Group docs, in order, into batches of at most `budget` tokens each."""
+    return list(iter_batches(docs, budget, count))
+
+
+def _map_batches(
+    map_fn: Callable[[List[Document]], str],
+    batches: Iterable[List[Document]],
+    max_workers: int,
+) -> List[str]:
+    # Like executor.map, but only takes the next batch off `batches` once a slot
+    # frees up, so at most max_workers batches are held at a time.
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for batch in batches:
+            in_flight.append(executor.submit(map_fn, batch))
+            if len(in_flight) >= max_workers:
+                results.append(in_flight.popleft().result())
+        while in_flight:
+            results.append(in_flight.popleft().result())
+    return results
+
+
+def _condensed_documents(texts: List[str], round_number: int) -> List[Document]:
+    return [
+        Document(
+            page_content=text,
+            metadata={"source": "map_reduce", "round": round_number, "batch": i},
+        )
+        for i, text in enumerate(texts)
+    ]
+
+
+def fit_documents(
+    docs: Iterable[Document],
+    budget: int,
+    map_fn: Callable[[List[Document]], str],
+    count: Callable[[str], int] = count_tokens,
+    max_workers: int = 4,
+    max_rounds: int = 3,
+) -> List[Document]:
+    """Return docs that fit in `budget` tokens, condensing them if needed.
+
+    When the docs do not fit in one batch, each batch is condensed with
+    `map_fn` (one LLM call per batch, run concurrently) and the results are
+    packed again, map-reduce style, until a single batch remains. `docs` is
+    read once: the first round condenses batches as they are packed, so a long
+    stream of docs is never held in memory all at once.
+
+    When condensing stops shrinking the input before it fits, only the first
+    batch is returned; the tokens left out are recorded as the
+    "tokens_dropped" metric of the current stage.
+    """
+    if budget < 1:
+        raise ValueError(f"Token budget must be positive, got {budget}")
+    stream = iter_batches(docs, budget, count)
+    first_batches = list(itertools.islice(stream, 2))
+    if len(first_batches) <= 1:
+        return first_batches[0] if first_batches else []
+
+    condensed = _map_batches(
+        map_fn, itertools.chain(first_batches, stream), max_workers
+    )
+    batches = pack_documents(_condensed_documents(condensed, 0), budget, count)
+    if len(batches) >= len(condensed):
+        max_rounds = 0  # condensing no longer shrinks the input
+    for round_number in range(1, max_rounds):
+        if len(batches) <= 1:
+            break
+        condensed = _map_batches(map_fn, batches, max_workers)
+        next_batches = pack_documents(
+            _condensed_documents(condensed, round_number), budget, count
+        )
+        if len(next_batches) >= len(batches):
+            batches = next_batches
+            break  # condensing no longer shrinks the input
+        batches = next_batches
+
+    if len(batches) > 1:
+        dropped = sum(count(doc.page_content) for batch in batches[1:] for doc in batch)
+        metrics.record(tokens_dropped=dropped)
+        print(
+            f"Warning: evidence still exceeds {budget} tokens after condensing; "
+            f"keeping the first {len(batches[0])} of {sum(map(len, batches))} parts "
+            f"({dropped} tokens dropped)"
+        )
+    return batches[0] if batches else []
@@ -0,0 +1,486 @@
+import functools
+import os
+from typing import TYPE_CHECKING, Callable, Iterable, List
+
+from langchain.prompts import PromptTemplate
+from langchain.schema.document import Document
+
+import metrics
+from artifacts import ArtifactStore, model_fingerprint
+from concurrency import run_concurrently
+from corpus import Corpus
+from llm_cache import install_llm_cache
+from loaders import (
+    LOADER_VERSION,
+    DocumentCache,
+    DocumentStream,
+    get_extractor,
+    load_documents,
+    start_process_pool,
+)
+from normalize import NORMALIZER_VERSION, NormalizedCache, normalize_documents
+from packing import count_tokens, fit_documents
+from relevance import select_passages
+from result_store import open_result_store
+from utils import file_digest
+
+if TYPE_CHECKING:
+    from langchain.chains import StuffDocumentsChain
+
+# Loading, clients, caches and the evaluation loop shared by eval_inno_dev.py and
+# generate_tags.py (and run_tasks.py). The scripts keep their prompts, stage
+# functions and outputs; settings below apply to every script.
+
+VERBOSE = False
+
+# Number of results evaluated concurrently. Per-provider request caps are set in
+# concurrency.PROVIDER_CONCURRENCY (or via concurrency.set_provider_concurrency).
+MAX_WORKERS = 8
+
+# Responses are cached on disk, keyed on model, generation parameters and the
+# rendered prompt, so reruns only pay for prompts that actually changed.
+LLM_CACHE_PATH = "/home/ubuntu/.cache/ai_qa_assessment/llm_cache.sqlite"
+LLM_CACHE_MAX_AGE = 90 * 24 * 60 * 60  # seconds
+LLM_CACHE_MAX_BYTES = 2 * 1024**3
+
+# Extracted PDF pages, keyed on file content, so load_data skips pypdf on reruns.
+DOC_CACHE_DIR = "/home/ubuntu/.cache/ai_qa_assessment/documents"
+
+# The summary and notes prompts end with an opened XML tag; Bedrock output is
+# cut off as soon as the matching closing tag is streamed.
+SUMMARY_STOP_MARKER = "</summary>"
+NOTES_STOP_MARKER = "</notes>"
+
+# Least number of tokens left for the evidence in each summary and notes prompt,
+# however long the rest of the prompt (title, description) is.
+MIN_EVIDENCE_TOKENS = 4_000
+
+# Processes used for PDF text extraction, shared by all evaluation workers.
+PDF_WORKERS = os.cpu_count()
+
+# Evidence pages are read lazily, file by file, as passages are selected and
+# condensed, so memory per worker stays flat however large the evidence is.
+# Reading stops at the first limit reached for a result (None: no limit). Set
+# STREAM_EVIDENCE to False to load every evidence page up front.
+STREAM_EVIDENCE = True
+EVIDENCE_MAX_PAGES = 1_000
+EVIDENCE_MAX_CHARS = 4_000_000
+EVIDENCE_MAX_BYTES = None
+
+# Wall time, tokens, retries, pages and estimated cost of each stage are added
+# to every output record under "metrics". When set, they are also appended to
+# METRICS_PATH (JSON lines) and served for Prometheus on METRICS_PORT.
+METRICS_PATH = None
+METRICS_PORT = None
+
+# cProfile and tracemalloc snapshots of these results are written to PROFILE_DIR.
+PROFILE_RESULT_IDS = []
+PROFILE_DIR = "/home/ubuntu/.cache/ai_qa_assessment/profiles"
+
+# Folder index persisted between runs; only folders whose mtime changed are
+# walked again. Defaults to <root_path>/.corpus_manifest.json.
+CORPUS_MANIFEST_PATH = None
+
+AZURE_OPENAI_API_BASE = "https://so-azure-openai-dev.openai.azure.com/"
+AZURE_OPENAI_API_VERSION = "2023-07-01-preview"
+AZURE_DEPLOYMENT_NAME = "gpt35-baseline"
+AZURE_OPENAI_API_KEY = ""
+AZURE_OPENAI_API_TYPE = "azure"
+
+OPENAI_API_KEY = ""
+
+
+@functools.lru_cache(maxsize=None)
+def _install_llm_cache():
+    return install_llm_cache(
+        LLM_CACHE_PATH, max_age=LLM_CACHE_MAX_AGE, max_bytes=LLM_CACHE_MAX_BYTES
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _configure_clients():
+    from llms import configure_clients
+
+    configure_clients()
+
+
+# LLM clients are built on first use so importing the scripts stays cheap and
+# does not require cloud credentials.
+@functools.lru_cache(maxsize=None)
+def get_llm_azure():
+    from llms import NewAzureChatOpenAI
+
+    _install_llm_cache()
+    _configure_clients()
+    return NewAzureChatOpenAI(
+        openai_api_base=AZURE_OPENAI_API_BASE,
+        openai_api_version=AZURE_OPENAI_API_VERSION,
+        deployment_name=AZURE_DEPLOYMENT_NAME,
+        openai_api_key=AZURE_OPENAI_API_KEY,
+        openai_api_type=AZURE_OPENAI_API_TYPE,
+        temperature=0.0,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_openai():
+    from llms import NewChatOpenAI
+
+    _install_llm_cache()
+    _configure_clients()
+    return NewChatOpenAI(
+        openai_api_key=OPENAI_API_KEY, model_name="gpt-4", temperature=0
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_openai_35():
+    from llms import NewChatOpenAI
+
+    _install_llm_cache()
+    _configure_clients()
+    return NewChatOpenAI(
+        openai_api_key=OPENAI_API_KEY, model_name="gpt-3.5-turbo-16k", temperature=0
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_bedrock(*stop_markers: str):
+    from llms import NewBedrock
+
+    _install_llm_cache()
+    _configure_clients()
+    # Streams so generation stops at the first of `stop_markers` (the closing
+    # tag of the requested block) instead of running on to max_tokens_to_sample.
+    return NewBedrock(
+        model_id="anthropic.claude-v2",
+        streaming=True,
+        model_kwargs={"temperature": 0.2},
+        stop_markers=list(stop_markers),
+    )
+
+
+def get_llm(model: str):
+    """The client of a model named in EXTRACTION_MODELS or CLASSIFICATION_MODELS."""
+    factories = {
+        "gpt35-baseline": get_llm_azure,
+        "gpt-3.5-turbo-16k": get_llm_openai_35,
+        "gpt-4": get_llm_openai,
+    }
+    return factories[model]()
+
+
+def model_fingerprints(models):
+    return [model_fingerprint(get_llm(model)) for model in models]
+
+
+def lazy_attributes(module_name: str, get_corpus: Callable[[], Corpus]):
+    """A module __getattr__ serving the attributes that notebooks and scripts
+    used when the result maps and clients were built at import."""
+    attributes = {
+        "ID_CODE_RESULT_MAP": lambda: get_corpus().result_map,
+        "ID_CODE_EVIDENCE_MAP": lambda: get_corpus().evidence_map,
+        "result_codes": lambda: get_corpus().result_codes,
+        "llm_azure": get_llm_azure,
+        "llm_openai": get_llm_openai,
+        "llm_openai_35": get_llm_openai_35,
+        "llm_bedrock": get_llm_bedrock,
+    }
+
+    def __getattr__(name):
+        if name in attributes:
+            return attributes[name]()
+        raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+    return __getattr__
+
+
+document_prompt = PromptTemplate(
+    input_variables=["page_content"], template="{page_content}"
+)
+
+document_cache = DocumentCache(DOC_CACHE_DIR)
+
+# Normalized text of the files read so far, by sha256, shared by all results.
+normalized_cache = NormalizedCache()
+
+
+def load_data(result_id, corpus: Corpus) -> tuple[List[Document], Iterable[Document]]:
+    pool = start_process_pool(PDF_WORKERS)
+    evidence_list = corpus.evidence_map.get(result_id) or []
+    paths = [corpus.result_map.get(result_id), *evidence_list]
+    if paths[0] is None:
+        raise ValueError(f"No result PDF found for {result_id}")
+    digests = [corpus.file_digest(path) for path in paths]
+    with metrics.stage("load"):
+        # Evidence in formats without an extractor, or that fails to parse, is
+        # left out instead of failing the whole result. When streaming, only
+        # the result PDF is parsed here.
+        # Streamed evidence is counted by DocumentStream as it is read.
+        loaded = paths[:1] if STREAM_EVIDENCE else paths
+        result, *_evidence_docs = documents = load_documents(
+            loaded,
+            cache=document_cache,
+            pool=pool,
+            digests=digests,
+            skip_unreadable=True,
+        )
+        if result is None:
+            raise ValueError(f"Unable to read the result PDF of {result_id}")
+        read = [
+            (path, docs) for path, docs in zip(loaded, documents) if docs is not None
+        ]
+        _evidence_docs = [docs for docs in _evidence_docs if docs is not None]
+        metrics.record(
+            files=len(read),
+            bytes=sum(os.path.getsize(path) for path, _ in read),
+            pages=len(
+                {
+                    (doc.metadata.get("source"), doc.metadata.get("page"))
+                    for _, docs in read
+                    for doc in docs
+                }
+            ),
+        )
+
+    if STREAM_EVIDENCE:
+        evidence_docs = DocumentStream(
+            evidence_list,
+            cache=document_cache,
+            pool=pool,
+            digests=digests[1:],
+            skip_unreadable=True,
+            max_pages=EVIDENCE_MAX_PAGES,
+            max_chars=EVIDENCE_MAX_CHARS,
+            max_bytes=EVIDENCE_MAX_BYTES,
+        )
+        return result, evidence_docs
+
+    evidence_docs = []
+    for _docs in _evidence_docs:
+        for _doc in _docs:
+            evidence_docs.append(_doc)
+
+    return result, evidence_docs
+
+
+def lazy_loader(result_id, corpus: Corpus):
+    """load_data(result_id, corpus) on the first call, the same documents
+    afterwards."""
+
+    @functools.lru_cache(maxsize=None)
+    def load():
+        print("Loading PRMS result and evidence...")
+        return load_data(result_id, corpus)
+
+    return load
+
+
+def digest(path, corpus: Corpus):
+    if path is None:
+        return None
+    return corpus.file_digest(path) or file_digest(path)
+
+
+def stuff_chain(llm, prompt: PromptTemplate) -> "StuffDocumentsChain":
+    # langchain.chains imports most of langchain (~2s), so it is only imported
+    # once a chain is actually built.
+    from langchain.chains import LLMChain, StuffDocumentsChain
+
+    return StuffDocumentsChain(
+        llm_chain=LLMChain(llm=llm, prompt=prompt, verbose=VERBOSE),
+        document_prompt=document_prompt,
+        document_variable_name="text",
+        verbose=VERBOSE,
+    )
+
+
+def summarize_evidence(
+    evidence_docs,
+    project: dict,
+    notes_chain: "StuffDocumentsChain",
+    summary_chain: "StuffDocumentsChain",
+    queries: List[str],
+    top_k,
+    token_budget: int,
+) -> str:
+    """The summary of the `top_k` evidence passages closest to `queries`, first
+    condensed into notes when they exceed `token_budget` tokens. `project` holds
+    the other inputs of both prompts (title and description)."""
+    evidence_docs = select_passages(evidence_docs, queries, top_k)
+    budget = token_budget - count_tokens(
+        summary_chain.llm_chain.prompt.format(text="", **project)
+    )
+    if budget < MIN_EVIDENCE_TOKENS:
+        print(
+            f"Warning: the summary prompt leaves {budget} of {token_budget} tokens "
+            f"for the evidence; using {MIN_EVIDENCE_TOKENS}"
+        )
+        budget = MIN_EVIDENCE_TOKENS
+    evidence_docs = fit_documents(
+        evidence_docs,
+        budget,
+        metrics.bind(
+            lambda batch: notes_chain.run({"input_documents": batch, **project})
+        ),
+    )
+
+    return summary_chain.run({"input_documents": evidence_docs, **project})
+
+
+def _normalized(docs, paths, digests):
+    return normalize_documents(docs, dict(zip(paths, digests)), normalized_cache)
+
+
+def build_structured_result(
+    artifact_store: ArtifactStore,
+    result_id,
+    corpus: Corpus,
+    load,
+    inputs: dict,
+    extract: Callable[[List[Document]], dict],
+    normalize: bool,
+) -> dict:
+    """The "structured_result" artifact: `extract` run on the (normalized)
+    result PDF. `inputs` holds the extraction's prompt and models."""
+    result_path = corpus.result_map.get(result_id)
+    result_digest = digest(result_path, corpus)
+    with metrics.stage("extraction"):
+        return artifact_store.build(
+            "structured_result",
+            result_id,
+            {
+                **inputs,
+                "loader": LOADER_VERSION,
+                "result": result_digest,
+                "normalizer": NORMALIZER_VERSION if normalize else None,
+            },
+            lambda: extract(
+                _normalized(load()[0], [result_path], [result_digest])
+                if normalize
+                else load()[0]
+            ),
+        )
+
+
+def build_evidence_summary(
+    artifact_store: ArtifactStore,
+    result_id,
+    corpus: Corpus,
+    load,
+    inputs: dict,
+    summarize: Callable[[Iterable[Document]], str],
+    normalize: bool,
+) -> str:
+    """The "evidence_summary" artifact: `summarize` run on the (normalized)
+    evidence pages. `inputs` holds the prompts and project of the summary."""
+    evidence_paths = corpus.evidence_map.get(result_id) or []
+    evidence_digests = [digest(path, corpus) for path in evidence_paths]
+    with metrics.stage("summary"):
+        return artifact_store.build(
+            "evidence_summary",
+            result_id,
+            {
+                **inputs,
+                "models": [
+                    model_fingerprint(get_llm_bedrock(NOTES_STOP_MARKER)),
+                    model_fingerprint(get_llm_bedrock(SUMMARY_STOP_MARKER)),
+                ],
+                "loader": LOADER_VERSION,
+                "evidence": evidence_digests,
+                "normalizer": NORMALIZER_VERSION if normalize else None,
+                "evidence_limits": (
+                    [EVIDENCE_MAX_PAGES, EVIDENCE_MAX_CHARS, EVIDENCE_MAX_BYTES]
+                    if STREAM_EVIDENCE
+                    else None
+                ),
+            },
+            lambda: summarize(
+                _normalized(load()[1], evidence_paths, evidence_digests)
+                if normalize
+                else load()[1]
+            ),
+        )
+
+
+def evaluate_tracked(task: str, evaluate: Callable[..., dict], result_id, *args):
+    """evaluate(result_id, *args), with the metrics of the run (and a profile,
+    for PROFILE_RESULT_IDS) added to its output under "metrics"."""
+    with metrics.track(result_id, task=task) as result_metrics:
+        with metrics.profile(result_id, PROFILE_RESULT_IDS, PROFILE_DIR):
+            output = evaluate(result_id, *args)
+        result_metrics.finish()
+        output["metrics"] = result_metrics.to_dict()
+
+    return output
+
+
+def _cached_tokens(path: str, sha256: str):
+    # Tokens of a file whose pages are in document_cache, None otherwise.
+    try:
+        version = get_extractor(path).version
+    except ValueError:
+        return None
+    pages = document_cache.get(sha256, version)
+    if pages is None:
+        return None
+    return sum(count_tokens(text) for text, _ in pages)
+
+
+def print_duplicate_report(corpus: Corpus) -> None:
+    # Tokens are only known for the copies already in document_cache, e.g.
+    # parsed by an earlier run.
+    report = corpus.duplicate_report(_cached_tokens)
+    print(
+        f"Evidence: {report['files']} files, {report['duplicate_files']} duplicate "
+        f"copies ({report['duplicate_bytes'] / 1024**2:.1f} MB, "
+        f"{report['duplicate_tokens']} tokens) parsed once"
+    )
+
+
+def evaluate_results(
+    evaluate_result: Callable[..., dict],
+    corpus: Corpus,
+    max_workers=MAX_WORKERS,
+    output_path=None,
+    resume=True,
+):
+    """Run evaluate_result on every result of `corpus` not yet in output_path
+    (all of them unless `resume`); returns the last output."""
+    # if (
+    #     result_id
+    #     in (
+    #     )
+    # ):  # 791, 1876, 2097 - Bedrock timeout; 1035 - Bedrock input too long; 2171, 3418, 1103 - .pptx; 856, 2168, 2104, 3018, 2050 - paywall or no evidence
+    #     continue
+    start_process_pool(PDF_WORKERS)  # fork before the evaluation threads start
+    metrics.install_sinks(METRICS_PATH, METRICS_PORT)
+    store = open_result_store(output_path)
+    result_ids = corpus.result_codes
+    print_duplicate_report(corpus)
+    if resume:
+        completed = store.completed_result_ids()
+        result_ids = [r for r in result_ids if str(r) not in completed]
+        print(f"Resuming: {len(completed)} results already in {output_path}")
+
+    output = None
+    duplicate_tokens = 0
+    try:
+        for result_id, output, error in run_concurrently(
+            lambda result_id: evaluate_result(result_id, corpus=corpus),
+            result_ids,
+            max_workers=max_workers,
+        ):
+            if error is not None:
+                print(f"Error: Unable to evaluate result {result_id}: {error!r}")
+                continue
+
+            store.write(output)
+            duplicate_tokens += output["metrics"]["total"]["duplicate_tokens"]
+
+            print(output)
+        print(f"Near-duplicate evidence pages: {duplicate_tokens} tokens not prompted")
+    finally:
+        store.close()  # writes the last buffered records
+
+    return output
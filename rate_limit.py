@@ -0,0 +1,235 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+# Requests and tokens per minute allowed per LLM provider, shared by every
+# worker. Set these to the quotas of the deployment or account in use.
+PROVIDER_LIMITS: Dict[str, Dict[str, Optional[int]]] = {
+    "azure": {"rpm": 240, "tpm": 80_000},
+    "openai": {"rpm": 500, "tpm": 80_000},
+    "bedrock": {"rpm": 100, "tpm": 200_000},
+}
+
+MAX_RETRIES = 6
+BASE_DELAY = 2.0  # seconds
+MAX_DELAY = 60.0  # seconds
+
+# The effective rate is cut by this factor on every throttle, down to
+# MIN_RATE_FRACTION of the configured limit, and grows back by RECOVERY_STEP
+# of the limit per successful call (additive increase, multiplicative decrease).
+THROTTLE_BACKOFF = 0.5
+MIN_RATE_FRACTION = 0.1
+RECOVERY_STEP = 0.05
+
+# Matched against exception class names, error codes and messages.
+_THROTTLE_MARKERS = (
+    "ThrottlingException",
+    "TooManyRequests",
+    "RateLimitError",
+    "Too Many Requests",
+    "Rate limit",
+)
+_TRANSIENT_MARKERS = (
+    "ModelTimeoutException",
+    "ServiceUnavailable",
+    "InternalServerException",
+    "ModelNotReadyException",
+    "ModelStreamErrorException",
+    "Timeout",
+    "TimeoutError",
+    "ReadTimeoutError",
+    "ConnectTimeoutError",
+    "EndpointConnectionError",
+    "APIConnectionError",
+    "APIError",
+    "timed out",
+)
+_THROTTLE_STATUSES = {429}
+_TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Continuously refilled bucket holding up to one minute of `rate`.
+
+    The balance may go negative through debit(), which lets usage that is only
+    known after a call (e.g. completion tokens) delay the next callers.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.rate / 60
+        )
+        self.updated = now
+
+    def acquire(self, amount: float = 1) -> None:
+        # A request larger than the whole bucket waits for a full bucket.
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) * 60 / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def debit(self, amount: float) -> None:
+        with self._lock:
+            self._refill()
+            self.level -= amount
+
+    def set_rate(self, rate_per_minute: float) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = rate_per_minute
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits for one provider.
+
+    The effective rates adapt to the provider: they are cut on every throttle
+    and recover gradually on success, never exceeding the configured limits.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.limits = {"rpm": rpm, "tpm": tpm}
+        self.buckets = {
+            name: TokenBucket(limit) for name, limit in self.limits.items() if limit
+        }
+        self.fraction = 1.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0) -> None:
+        if "rpm" in self.buckets:
+            self.buckets["rpm"].acquire(1)
+        if "tpm" in self.buckets and tokens:
+            self.buckets["tpm"].acquire(tokens)
+
+    def record_tokens(self, tokens: int) -> None:
+        """Charge tokens that were only known after the call returned."""
+        if "tpm" in self.buckets and tokens:
+            self.buckets["tpm"].debit(tokens)
+
+    def _set_fraction(self, fraction: float) -> None:
+        self.fraction = min(1.0, max(MIN_RATE_FRACTION, fraction))
+        for name, bucket in self.buckets.items():
+            bucket.set_rate(self.limits[name] * self.fraction)
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            self._set_fraction(self.fraction * THROTTLE_BACKOFF)
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self.fraction < 1.0:
+                self._set_fraction(self.fraction + RECOVERY_STEP)
+
+
+_limiters_lock = threading.Lock()
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def set_rate_limits(
+    provider: str, rpm: Optional[int] = None, tpm: Optional[int] = None
+) -> None:
+    """Override the limits of `provider`; None disables that limit."""
+    with _limiters_lock:
+        PROVIDER_LIMITS[provider] = {"rpm": rpm, "tpm": tpm}
+        _limiters[provider] = RateLimiter(rpm=rpm, tpm=tpm)
+
+
+def get_rate_limiter(provider: str) -> RateLimiter:
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            limiter = RateLimiter(**PROVIDER_LIMITS.get(provider, {}))
+            _limiters[provider] = limiter
+        return limiter
+
+
+def _error_description(error: BaseException) -> str:
+    # Class names along the MRO, the botocore error code and the message, so
+    # errors can be classified without importing botocore or openai.
+    parts = [cls.__name__ for cls in type(error).__mro__]
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        parts.append(str(response.get("Error", {}).get("Code", "")))
+    parts.append(str(error))
+    return " ".join(parts)
+
+
+def _error_status(error: BaseException) -> Optional[int]:
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return getattr(error, "http_status", None) or getattr(error, "status_code", None)
+
+
+def is_throttle_error(error: BaseException) -> bool:
+    if _error_status(error) in _THROTTLE_STATUSES:
+        return True
+    description = _error_description(error)
+    return any(marker in description for marker in _THROTTLE_MARKERS)
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """Whether `error` is a throttle or a transient failure worth retrying."""
+    if is_throttle_error(error) or _error_status(error) in _TRANSIENT_STATUSES:
+        return True
+    description = _error_description(error)
+    return any(marker in description for marker in _TRANSIENT_MARKERS)
+
+
+def backoff_delay(attempt: int) -> float:
+    # Full jitter: uniform in [0, min(MAX_DELAY, BASE_DELAY * 2**attempt)].
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2**attempt))
+
+
+def call_with_retry(
+    provider: str,
+    func: Callable[[], T],
+    tokens: int = 0,
+    max_retries: int = MAX_RETRIES,
+) -> T:
+    """Call `func` within the rate limits of `provider`, retrying on throttles
+    and transient errors with jittered exponential backoff.
+
+    `tokens` is the estimated prompt size charged against the tokens-per-minute
+    limit. Errors that are not retryable, and the last error once retries are
+    exhausted, are raised unchanged.
+    """
+    limiter = get_rate_limiter(provider)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            result = func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            throttled = is_throttle_error(e)
+            if throttled:
+                limiter.on_throttle()
+            delay = backoff_delay(attempt)
+            kind = "Throttled" if throttled else "Transient error"
+            print(
+                f"{kind} by {provider} ({type(e).__name__}), retrying in "
+                f"{delay:.1f}s ({attempt + 1}/{max_retries})"
+            )
+            metrics.record(retries=1)
+            time.sleep(delay)
+        else:
+            limiter.on_success()
+            return result
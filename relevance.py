@@ -0,0 +1,170 @@
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from langchain.schema.document import Document
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in into is it its of on or that "
+    "the their this to was were which with".split()
+)
+_SUFFIX_RE = re.compile(r"(?:ing|ed|es|s)$")
+
+
+def tokenize(text: str) -> List[str]:
+    # Lowercased words without stopwords and with a crude suffix strip, so
+    # "tested"/"testing"/"tests" all match "test".
+    return [
+        _SUFFIX_RE.sub("", word) if len(word) > 4 else word
+        for word in _WORD_RE.findall(text.lower())
+        if word not in _STOPWORDS
+    ]
+
+
+def _idf(doc_freqs: Counter, n: int) -> Dict[str, float]:
+    return {
+        term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for term, df in doc_freqs.items()
+    }
+
+
+def _score(tf: Counter, length: int, terms, idf, avg_length, k1, b) -> float:
+    norm = k1 * (1 - b + b * length / (avg_length or 1))
+    score = 0.0
+    for term in terms:
+        freq = tf.get(term)
+        if freq:
+            score += idf[term] * freq * (k1 + 1) / (freq + norm)
+    return score
+
+
+def _round_robin(rankings: List[List[int]], k: int) -> List[int]:
+    # Queries take turns picking their next best unpicked doc.
+    chosen = set()
+    for rank in range(max(map(len, rankings), default=0)):
+        for ranking in rankings:
+            if len(chosen) >= k:
+                return sorted(chosen)
+            if rank < len(ranking):
+                chosen.add(ranking[rank])
+    return sorted(chosen)
+
+
+class BM25Index:
+    """Okapi BM25 over a list of documents, built in memory with no network."""
+
+    def __init__(self, docs: Sequence[Document], k1: float = 1.5, b: float = 0.75):
+        self.docs = list(docs)
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize(doc.page_content)) for doc in self.docs]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.docs else 0.0
+        doc_freqs: Counter = Counter()
+        for tf in self.term_freqs:
+            doc_freqs.update(tf.keys())
+        self.idf = _idf(doc_freqs, len(self.docs))
+
+    def scores(self, query: str) -> List[float]:
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        return [
+            _score(tf, length, terms, self.idf, self.avg_length, self.k1, self.b)
+            for tf, length in zip(self.term_freqs, self.lengths)
+        ]
+
+    def top_k(self, queries: Sequence[str], k: int) -> List[Document]:
+        """The k docs most relevant to `queries`, in their original order.
+
+        Queries take turns picking their next best unpicked doc, so every query
+        (e.g. every impact area) gets passages even when one facet dominates
+        the evidence.
+        """
+        rankings = []
+        for query in queries:
+            scores = self.scores(query)
+            ranked = sorted(range(len(scores)), key=lambda i: -scores[i])
+            rankings.append([i for i in ranked if scores[i] > 0])
+
+        chosen = set(_round_robin(rankings, k))
+
+        # Fewer than k docs matched any query: fill up in document order.
+        for i in range(len(self.docs)):
+            if len(chosen) >= k:
+                break
+            chosen.add(i)
+        return [self.docs[i] for i in sorted(chosen)]
+
+
+def stream_top_k(
+    docs: Iterable[Document],
+    queries: Sequence[str],
+    k: int,
+    k1: float = 1.5,
+    b: float = 0.75,
+) -> List[Document]:
+    """BM25Index(docs).top_k(queries, k) over a re-iterable stream of docs.
+
+    Reads `docs` twice: once for the document frequencies, once to score each
+    doc. Only the best k docs per query (and the first k docs, to fill up when
+    few match) are kept, instead of every passage of the evidence.
+    """
+    doc_freqs: Counter = Counter()
+    n = total_length = 0
+    for doc in docs:
+        tf = Counter(tokenize(doc.page_content))
+        doc_freqs.update(tf.keys())
+        total_length += sum(tf.values())
+        n += 1
+    idf = _idf(doc_freqs, n)
+    avg_length = total_length / n if n else 0.0
+    query_terms = [[t for t in set(tokenize(q)) if t in idf] for q in queries]
+
+    # Min-heaps of (score, -position): ties go to the earlier doc, as in top_k.
+    heaps: List[list] = [[] for _ in queries]
+    kept: Dict[int, Document] = {}
+    for i, doc in enumerate(docs):
+        tf = Counter(tokenize(doc.page_content))
+        length = sum(tf.values())
+        if i < k:
+            kept[i] = doc
+        for heap, terms in zip(heaps, query_terms):
+            score = _score(tf, length, terms, idf, avg_length, k1, b)
+            if score <= 0:
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -i))
+            elif (score, -i) > heap[0]:
+                heapq.heapreplace(heap, (score, -i))
+            kept[i] = doc
+        if len(kept) > 2 * k * max(len(heaps), 1):
+            needed = {-j for heap in heaps for _, j in heap} | set(range(k))
+            kept = {j: d for j, d in kept.items() if j in needed}
+
+    rankings = [[-j for _, j in sorted(heap, reverse=True)] for heap in heaps]
+    chosen = set(_round_robin(rankings, k))
+    for i in range(min(k, n)):
+        if len(chosen) >= k:
+            break
+        chosen.add(i)
+    return [kept[i] for i in sorted(chosen)]
+
+
+def select_passages(
+    docs: Iterable[Document], queries: Sequence[str], k: Optional[int]
+) -> Iterable[Document]:
+    """Keep the top-k passages for `queries`; k=None keeps every passage.
+
+    A list is ranked in memory. Any other iterable is taken to be a re-iterable
+    stream (e.g. loaders.DocumentStream): it is ranked with stream_top_k, or
+    returned as is when k is None. One-shot iterators are read into a list.
+    """
+    if k is not None and iter(docs) is docs:
+        docs = list(docs)
+    if not isinstance(docs, Sequence):
+        return docs if k is None else stream_top_k(docs, queries, k)
+    if k is None or len(docs) <= k:
+        return list(docs)
+    return BM25Index(docs).top_k(queries, k)
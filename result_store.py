@@ -0,0 +1,387 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+# Columns and headers of the Excel files handed over after each run, as
+# produced by cleanup_readiness_evals.ipynb and cleanup_ia_tags.ipynb.
+EXCEL_LAYOUTS: Dict[str, List[Tuple[str, str]]] = {
+    "readiness": [
+        ("result_id", "result_id"),
+        ("reported_readiness_level", "reported_readiness_level"),
+        ("reported_readiness_justif", "reported_readiness_justif"),
+        ("ai_readiness_level", "ai_readiness_level"),
+        ("ai_readiness_justif", "ai_readiness_justif"),
+    ],
+    "ia_tags": [
+        ("result_id", "Result ID"),
+        ("reported_geographic_focus", "Reported Geographic Focus"),
+        ("reported_region", "Reported Region"),
+        ("reported_country", "Reported Country"),
+        ("reported_gender_tag", "Reported Gender Tag"),
+        ("reported_climate_tag", "Reported Climate Tag"),
+        ("reported_nutrition_tag", "Reported Nutrition Tag"),
+        ("reported_environment_tag", "Reported Environment Tag"),
+        ("reported_poverty_tag", "Reported Poverty Tag"),
+        ("ai_geographic_focus", "AI Geographic Focus"),
+        ("ai_region", "AI Region"),
+        ("ai_country", "AI Country"),
+        ("ai_gender_tag", "AI Gender Tag"),
+        ("ai_climate_tag", "AI Climate Tag"),
+        ("ai_nutrition_tag", "AI Nutrition Tag"),
+        ("ai_environment_tag", "AI Environment Tag"),
+        ("ai_poverty_tag", "AI Poverty Tag"),
+        ("ai_gender_tag_just", "AI Gender Tag Justification"),
+        ("ai_climate_tag_just", "AI Climate Tag Justification"),
+        ("ai_nutrition_tag_just", "AI Nutrition Tag Justification"),
+        ("ai_environment_tag_just", "AI Environment Tag Justification"),
+        ("ai_poverty_tag_just", "AI Poverty Tag Justification"),
+    ],
+}
+
+
+_CREATE_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS results (
+        result_id TEXT PRIMARY KEY,
+        updated_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS columns (
+        name TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        encoding TEXT NOT NULL
+    )
+    """,
+)
+
+
+class JsonlResultStore:
+    """Append-only JSON lines file of evaluation records keyed by result_id."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tail_checked = False
+
+    def completed_result_ids(self) -> Set[str]:
+        """Stream the file once and return the result_ids already written.
+
+        Lines that cannot be parsed (e.g. a record cut short by a crash) are
+        ignored so the corresponding result is evaluated again.
+        """
+        completed = set()
+        if not os.path.exists(self.path):
+            return completed
+
+        for record in read_jsonl(self.path):
+            completed.add(str(record["result_id"]))
+
+        return completed
+
+    def write(self, record: dict) -> None:
+        with self._lock:
+            needs_newline = False
+            if not self._tail_checked:
+                # Terminate a line left incomplete by an interrupted run so the
+                # next record does not get glued onto it.
+                if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                    with open(self.path, "rb") as f:
+                        f.seek(-1, os.SEEK_END)
+                        needs_newline = f.read(1) != b"\n"
+                self._tail_checked = True
+
+            with open(self.path, "a") as f:  # updates to .jsonl
+                if needs_newline:
+                    f.write("\n")
+                json.dump(record, f)
+                f.write("\n")
+
+    def flush(self) -> None:
+        pass  # every record is written as it comes
+
+    def close(self) -> None:
+        pass
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    """The records of a JSONL result file, skipping lines that do not parse."""
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict) and "result_id" in record:
+                yield record
+
+
+def _quote(name: str) -> str:
+    if '"' in name or "\x00" in name:
+        raise ValueError(f"Unsupported column name {name!r}")
+    return f'"{name}"'
+
+
+def _is_scalar(value) -> bool:
+    return value is None or (
+        isinstance(value, (str, int, float)) and not isinstance(value, bool)
+    )
+
+
+def _encode(value, encoding: str):
+    return json.dumps(value) if encoding == "json" else value
+
+
+def _cell(value):
+    # Lists (regions, countries, ...) become one comma-separated cell.
+    if isinstance(value, list):
+        return ", ".join(str(v) for v in value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+class SqliteResultStore:
+    """SQLite table of evaluation records with one row per result_id.
+
+    Each record field gets its own column (added as new fields appear); a
+    column that has held a list or dict stores every value as JSON. Writing a
+    result_id again replaces its row, so reruns update results instead of
+    piling up duplicates. Records are buffered and written `batch_size` at a
+    time (or after `flush_interval` seconds) in a single transaction, so a
+    crash loses at most the unflushed batch and never leaves a partial one.
+    Call close() at the end of a run.
+    """
+
+    def __init__(self, path: str, batch_size: int = 25, flush_interval: float = 30):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._buffer: Dict[str, dict] = {}
+        self._last_flush = time.monotonic()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            for statement in _CREATE_TABLES:
+                conn.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _columns(self, conn: sqlite3.Connection) -> Dict[str, str]:
+        rows = conn.execute("SELECT name, encoding FROM columns ORDER BY position")
+        return dict(rows.fetchall())
+
+    def _upgrade_column(self, conn: sqlite3.Connection, name: str) -> None:
+        # Re-encode the plain values already stored so the column decodes as a
+        # whole, e.g. after a field that was None gets its first dict.
+        column = _quote(name)
+        rows = conn.execute(
+            f"SELECT result_id, {column} FROM results WHERE {column} IS NOT NULL"
+        ).fetchall()
+        conn.executemany(
+            f"UPDATE results SET {column} = ? WHERE result_id = ?",
+            [(json.dumps(value), result_id) for result_id, value in rows],
+        )
+        conn.execute("UPDATE columns SET encoding = 'json' WHERE name = ?", (name,))
+
+    def write(self, record: dict) -> None:
+        with self._lock:
+            self._buffer[str(record["result_id"])] = record
+            if (
+                len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self.flush()
+
+    def write_many(self, records) -> int:
+        count = 0
+        for record in records:
+            self.write(record)
+            count += 1
+        self.flush()
+        return count
+
+    def flush(self) -> None:
+        """Upsert the buffered records in one transaction."""
+        with self._lock:
+            records = list(self._buffer.values())
+            self._last_flush = time.monotonic()
+            if not records:
+                return
+
+            conn = self._connection()
+            with conn:
+                # New columns are added, and columns that get their first list
+                # or dict switched to JSON, in the same transaction as the rows.
+                conn.execute("BEGIN")
+                columns = self._columns(conn)
+                for record in records:
+                    for name, value in record.items():
+                        if name == "result_id" or columns.get(name) == "json":
+                            continue
+                        encoding = "value" if _is_scalar(value) else "json"
+                        if name not in columns:
+                            conn.execute(
+                                f"ALTER TABLE results ADD COLUMN {_quote(name)}"
+                            )
+                            conn.execute(
+                                "INSERT INTO columns (name, position, encoding) "
+                                "VALUES (?, ?, ?)",
+                                (name, len(columns), encoding),
+                            )
+                        elif encoding == "json":
+                            self._upgrade_column(conn, name)
+                        columns[name] = encoding
+
+                now = time.time()
+                for record in records:
+                    names = [name for name in record if name != "result_id"]
+                    quoted = [_quote(name) for name in ("updated_at", *names)]
+                    updates = ", ".join(f"{q} = excluded.{q}" for q in quoted)
+                    conn.execute(
+                        f"INSERT INTO results (result_id, {', '.join(quoted)}) "
+                        f"VALUES ({', '.join('?' * (len(quoted) + 1))}) "
+                        f"ON CONFLICT(result_id) DO UPDATE SET {updates}",
+                        (
+                            str(record["result_id"]),
+                            now,
+                            *(_encode(record[name], columns[name]) for name in names),
+                        ),
+                    )
+            self._buffer.clear()
+
+    def close(self) -> None:
+        self.flush()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __enter__(self) -> "SqliteResultStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def completed_result_ids(self) -> Set[str]:
+        with self._lock:
+            completed = set(self._buffer)
+        rows = self._connection().execute("SELECT result_id FROM results")
+        completed.update(result_id for (result_id,) in rows)
+        return completed
+
+    def records(self, fields: Optional[Sequence[str]] = None) -> Iterator[dict]:
+        """Stream the stored records (only `fields`, if given) by result_id.
+
+        result_ids that look like integers come back as int, as in the JSONL
+        files.
+        """
+        self.flush()
+        conn = self._connection()
+        columns = self._columns(conn)
+        names = [name for name in fields or columns if name != "result_id"]
+        missing = [name for name in names if name not in columns]
+        selected = ["result_id", *(name for name in names if name in columns)]
+        rows = conn.execute(
+            f"SELECT {', '.join(_quote(name) for name in selected)} FROM results "
+            "ORDER BY CAST(result_id AS INTEGER), result_id"
+        )
+        for row in rows:
+            record = {}
+            for name, value in zip(selected, row):
+                if name == "result_id":
+                    value = int(value) if value.lstrip("-").isdigit() else value
+                elif value is not None and columns[name] == "json":
+                    value = json.loads(value)
+                record[name] = value
+            for name in missing:
+                record[name] = None
+            yield record
+
+    def import_jsonl(self, path: str) -> int:
+        """Load a JSONL result file; later lines win over earlier ones."""
+        return self.write_many(read_jsonl(path))
+
+    def export_excel(
+        self, path: str, layout: Union[str, Sequence[Tuple[str, str]], None] = None
+    ) -> int:
+        """Write the records to an .xlsx file, one row per result_id.
+
+        `layout` is a key of EXCEL_LAYOUTS or a list of (field, header) pairs;
+        by default every column is written under its field name. The workbook
+        is streamed row by row and moved into place once complete.
+        """
+        import openpyxl
+
+        if isinstance(layout, str):
+            layout = EXCEL_LAYOUTS[layout]
+        if layout is None:
+            fields = ["result_id", *self._columns(self._connection())]
+            layout = [(field, field) for field in fields]
+
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append([header for _, header in layout])
+        count = 0
+        for record in self.records([field for field, _ in layout]):
+            sheet.append([_cell(record[field]) for field, _ in layout])
+            count += 1
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".xlsx.tmp")
+        os.close(fd)
+        try:
+            workbook.save(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return count
+
+
+def open_result_store(path: str):
+    """SqliteResultStore for .sqlite/.db paths, JsonlResultStore otherwise."""
+    if os.path.splitext(path)[1] in (".sqlite", ".sqlite3", ".db"):
+        return SqliteResultStore(path)
+    return JsonlResultStore(path)
+
+
+if __name__ == "__main__":
+    # python result_store.py import readiness.jsonl readiness.sqlite
+    # python result_store.py export readiness.sqlite readiness.xlsx --layout readiness
+    parser = argparse.ArgumentParser(description="Convert and export result stores")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="load a JSONL file")
+    import_parser.add_argument("jsonl_path")
+    import_parser.add_argument("store_path")
+    export_parser = commands.add_parser("export", help="write an Excel file")
+    export_parser.add_argument("store_path")
+    export_parser.add_argument("xlsx_path")
+    export_parser.add_argument("--layout", choices=sorted(EXCEL_LAYOUTS))
+    args = parser.parse_args()
+
+    with SqliteResultStore(args.store_path) as store:
+        if args.command == "import":
+            count = store.import_jsonl(args.jsonl_path)
+            print(f"Imported {count} records into {args.store_path}")
+        else:
+            count = store.export_excel(args.xlsx_path, args.layout)
+            print(f"Exported {count} results to {args.xlsx_path}")
@@ -0,0 +1,170 @@
+import functools
+from typing import TYPE_CHECKING
+
+from langchain.output_parsers import PydanticOutputParser
+from langchain.prompts import PromptTemplate
+
+import eval_inno_dev
+import generate_tags
+import metrics
+import pipeline
+from artifacts import ArtifactStore
+from cascade import CASCADE_VERSION, check_result_extraction, run_cascade
+from concurrency import run_concurrently
+from corpus import Corpus
+from loaders import start_process_pool
+from result_store import open_result_store
+from utils import ResultExtraction
+
+if TYPE_CHECKING:
+    from langchain.chains import StuffDocumentsChain
+
+# Runs several evaluations over one result tree, parsing each result's PDFs once
+# and extracting result.pdf once for all of them. Each task keeps its own
+# prompts, artifacts and OUTPUT_PATH.
+TASKS = {
+    "readiness": eval_inno_dev,
+    "tags": generate_tags,
+}
+
+# The slice of the shared extraction that each task uses as its structured result.
+TASK_EXTRACTION_KEYS = {
+    "readiness": "innovation_profile",
+    "tags": "project",
+}
+
+MAX_WORKERS = pipeline.MAX_WORKERS
+
+ARTIFACTS_DIR = "/home/ubuntu/.cache/ai_qa_assessment/artifacts/run_tasks"
+
+# Whether the shared extraction is prompted with normalized text (see
+# NORMALIZE_STAGES in the task scripts, which cover the other stages).
+NORMALIZE_EXTRACTION = False
+
+# Models tried in turn by the shared extraction (see EXTRACTION_MODELS in the
+# task scripts).
+EXTRACTION_MODELS = ["gpt-3.5-turbo-16k", "gpt-4"]
+
+# Metrics of the shared stages (loading, extraction) are added to each task's
+# record under "metrics"/"shared", and sent to the sinks once per result.
+METRICS_PATH = None
+METRICS_PORT = None
+
+root_path = "/home/ubuntu/data/2023"
+
+extraction_output_parser = PydanticOutputParser(pydantic_object=ResultExtraction)
+extraction_format_instructions = extraction_output_parser.get_format_instructions()
+
+# Both scripts use the same extraction instructions; only the schema differs.
+extraction_template = eval_inno_dev.extraction_template
+
+artifact_store = ArtifactStore(ARTIFACTS_DIR)
+
+
+@functools.lru_cache(maxsize=None)
+def get_extraction_chain(model: str) -> "StuffDocumentsChain":
+    extraction_prompt = PromptTemplate.from_template(
+        template=extraction_template,
+        partial_variables={"format_instructions": extraction_format_instructions},
+    )
+    return pipeline.stuff_chain(pipeline.get_llm(model), extraction_prompt)
+
+
+def get_shared_structured_result(result) -> dict:
+    structured_result = run_cascade(
+        "extraction",
+        EXTRACTION_MODELS,
+        lambda model: get_extraction_chain(model).run({"input_documents": result}),
+        check_result_extraction,
+    )
+
+    return structured_result
+
+
+def evaluate_result(result_id, task_names, corpus: Corpus) -> dict:
+    """Run `task_names` on one result; returns {task_name: output or error}."""
+    load = pipeline.lazy_loader(result_id, corpus)
+
+    print(f"Getting shared structured result for {result_id}...")
+    with metrics.track(result_id, task="run_tasks") as shared_metrics:
+        extraction = pipeline.build_structured_result(
+            artifact_store,
+            result_id,
+            corpus,
+            load,
+            {
+                "template": extraction_template,
+                "format_instructions": extraction_format_instructions,
+                "models": pipeline.model_fingerprints(EXTRACTION_MODELS),
+                "cascade": CASCADE_VERSION,
+            },
+            get_shared_structured_result,
+            normalize=NORMALIZE_EXTRACTION,
+        )
+
+    outputs = {}
+    for name in task_names:
+        try:
+            outputs[name] = TASKS[name].evaluate_result(
+                result_id,
+                load=load,
+                structured_result=extraction[TASK_EXTRACTION_KEYS[name]],
+                corpus=corpus,
+            )
+            outputs[name]["metrics"]["shared"] = shared_metrics.to_dict()
+        except Exception as e:
+            outputs[name] = e
+    return outputs
+
+
+def run_tasks(
+    task_names=tuple(TASKS), root_path=root_path, max_workers=MAX_WORKERS, resume=True
+) -> None:
+    corpus = Corpus(root_path)  # every task reads the same result tree
+
+    start_process_pool(pipeline.PDF_WORKERS)
+    metrics.install_sinks(METRICS_PATH, METRICS_PORT)
+    stores = {name: open_result_store(TASKS[name].OUTPUT_PATH) for name in task_names}
+    completed = {
+        name: store.completed_result_ids() if resume else set()
+        for name, store in stores.items()
+    }
+    pending = {
+        result_id: [
+            name for name in task_names if str(result_id) not in completed[name]
+        ]
+        for result_id in corpus.result_codes
+    }
+    pending = {result_id: names for result_id, names in pending.items() if names}
+    print(f"Running {', '.join(task_names)} on {len(pending)} results")
+    pipeline.print_duplicate_report(corpus)
+
+    duplicate_tokens = 0
+    try:
+        for result_id, outputs, error in run_concurrently(
+            lambda result_id: evaluate_result(result_id, pending[result_id], corpus),
+            list(pending),
+            max_workers=max_workers,
+        ):
+            if error is not None:
+                print(f"Error: Unable to evaluate result {result_id}: {error!r}")
+                continue
+
+            for name, output in outputs.items():
+                if isinstance(output, Exception):
+                    print(
+                        f"Error: Unable to run {name} on result {result_id}: "
+                        f"{output!r}"
+                    )
+                    continue
+                stores[name].write(output)
+                duplicate_tokens += output["metrics"]["total"]["duplicate_tokens"]
+                print(output)
+        print(f"Near-duplicate evidence pages: {duplicate_tokens} tokens not prompted")
+    finally:
+        for store in stores.values():
+            store.close()
+
+
+if __name__ == "__main__":
+    run_tasks()
@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+_CREATE_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS downloads (
+        url TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        size INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS handles (
+        url TEXT PRIMARY KEY,
+        links TEXT NOT NULL,
+        resolved_at REAL NOT NULL
+    )
+    """,
+)
+
+
+class ScrapeCache:
+    """SQLite store of what earlier scraping runs fetched.
+
+    Holds, per downloaded URL, the file it was saved to with its size, sha256
+    and HTTP validators (ETag, Last-Modified), so the next run can send a
+    conditional request and skip unchanged files; and, per handle page, the
+    evidence links it resolved to, so the page is not fetched and parsed
+    again. Handle entries older than `max_age` seconds are resolved again.
+    """
+
+    def __init__(self, path: str, max_age: Optional[float] = None):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            for statement in _CREATE_TABLES:
+                conn.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_links(self, url: str) -> Optional[List[str]]:
+        row = (
+            self._connection()
+            .execute("SELECT links, resolved_at FROM handles WHERE url = ?", (url,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        links, resolved_at = row
+        if self.max_age is not None and time.time() - resolved_at > self.max_age:
+            return None
+        return json.loads(links)
+
+    def put_links(self, url: str, links: List[str]) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO handles (url, links, resolved_at) "
+                "VALUES (?, ?, ?)",
+                (url, json.dumps(links), time.time()),
+            )
+
+    def get_download(self, url: str, path: str) -> Optional[dict]:
+        """The cached download of `url`, if it is still on disk at `path`."""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT etag, last_modified, size, sha256 FROM downloads "
+                "WHERE url = ? AND path = ?",
+                (url, path),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        etag, last_modified, size, sha256 = row
+        try:
+            if os.path.getsize(path) != size:
+                return None
+        except FileNotFoundError:
+            return None
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": size,
+            "sha256": sha256,
+        }
+
+    def put_download(
+        self,
+        url: str,
+        path: str,
+        size: int,
+        sha256: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO downloads "
+                "(url, path, etag, last_modified, size, sha256, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, path, etag, last_modified, size, sha256, time.time()),
+            )
@@ -0,0 +1,370 @@
+import functools
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from bs4 import BeautifulSoup
+
+from concurrency import run_concurrently
+from corpus import RESULT_FILENAME, CorpusIndex
+from scrape_cache import ScrapeCache
+
+# Requests in flight per host, across all threads, and connections kept alive
+# per host.
+MAX_PER_HOST = 4
+
+TIMEOUT = (10, 120)  # seconds: connect, read
+CHUNK_SIZE = 1024 * 1024
+
+EVIDENCE_EXTENSIONS = (".pdf", ".pptx")
+
+# PRMS report of a result; the 2022 reports are under phase=1.
+RESULT_PDF_URL = "https://api.reporting.cgiar.org/api/platform-report/result/{id}"
+# Results not available on PRMS (2022).
+MISSING_RESULTS = (754, 999, 1783, 28, 1003, 35, 455)
+
+# A PDF starts with this header and ends with an %%EOF marker, which writers
+# may follow with a few bytes of whitespace.
+PDF_HEADER = b"%PDF-"
+PDF_EOF = b"%%EOF"
+PDF_TAIL_SIZE = 1024
+
+CGSPACE_HANDLE_RE = re.compile("^https://cgspace.cgiar.org/handle/")
+# Handles that break the link resolution; their evidence is fetched by hand.
+SKIPPED_HANDLES = (
+    "https://cgspace.cgiar.org/handle/10568/131688",
+    "https://cgspace.cgiar.org/handle/10568/132210",
+)
+
+_PDF_HREF_RE = re.compile(r".*\.pdf$")
+_CITATION_META_RE = re.compile("citation_(pdf|abstract)_url")
+# Publishers whose article pages (reached through a doi.org link) carry the PDF
+# in a citation meta tag.
+_CITATION_META_PUBLISHERS = (
+    re.compile(
+        "^https://academic.oup.com/(wber/article/|af/article/|cdj/advance-article/)"
+    ),
+    re.compile("^https://link.springer.com/article/"),
+    re.compile("^https://gh.bmj.com/content/"),
+)
+_NATURE_RE = re.compile("^https://www.nature.com/articles/")
+_BIOMEDCENTRAL_RE = re.compile("^https://cabiagbio.biomedcentral.com/articles/")
+# still in development - if https://doi.org/ redirects to https://www.sciencedirect.com/ then scrape https://www.sciencedirect.com/[...]-main.pdf - https://doi.org/10.1016/j.ehb.2022.101185, https://doi.org/10.1016/j.pce.2021.103082
+# still in development - if https://doi.org/ redirects to https://www.cambridge.org/core/journals/ then scrape https://www.cambridge.org/core/services/aop-cambridge-core/content/view/[...].pdf
+
+
+@functools.lru_cache(maxsize=None)
+def random_user_agent() -> str:
+    # One User-Agent per process: a new one on every request only defeats
+    # connection reuse on servers that key sessions on it.
+    from fake_useragent import UserAgent
+
+    return str(UserAgent(min_percentage=2.1).random)
+
+
+def is_url(cell) -> bool:
+    return bool(re.match("^https?://", str(cell)))
+
+
+def get_filename(link: str) -> str:
+    return os.path.splitext(os.path.basename(urlsplit(link)[2]))[0]
+
+
+def get_extension(link: str) -> str:
+    return os.path.splitext(os.path.basename(urlsplit(link)[2]))[1]
+
+
+def looks_like_pdf(path: str) -> bool:
+    """Cheap validity check: PDF header at the start, %%EOF near the end."""
+    with open(path, "rb") as f:
+        if f.read(len(PDF_HEADER)) != PDF_HEADER:
+            return False
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - PDF_TAIL_SIZE))
+        return PDF_EOF in f.read()
+
+
+class Scraper:
+    """Resolves evidence links and downloads them, safe to share across threads.
+
+    Each host gets its own pooled keep-alive session and a cap of
+    `max_per_host` concurrent requests, so many workers can fetch from
+    CGSpace and publishers at once without opening a connection per request.
+
+    With a `cache`, handle pages resolved by an earlier run are not fetched
+    again, and files downloaded before are requested conditionally (ETag /
+    Last-Modified), so only changed files are transferred and rewritten.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int = MAX_PER_HOST,
+        timeout=TIMEOUT,
+        user_agent: Optional[str] = None,
+        handle_re: re.Pattern = CGSPACE_HANDLE_RE,
+        cache: Optional[ScrapeCache] = None,
+    ):
+        self.max_per_host = max_per_host
+        self.cache = cache
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.handle_re = handle_re
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        self._slots: Dict[str, threading.BoundedSemaphore] = {}
+
+    def _host(self, url: str) -> str:
+        return urlsplit(url).netloc.lower()
+
+    def session(self, url: str) -> requests.Session:
+        host = self._host(url)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_per_host
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = self.user_agent or random_user_agent()
+                self._sessions[host] = session
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return session
+
+    @contextmanager
+    def _slot(self, url: str) -> Iterator[requests.Session]:
+        session = self.session(url)
+        with self._slots[self._host(url)]:
+            yield session
+
+    def get(self, url: str) -> requests.Response:
+        with self._slot(url) as session:
+            return session.get(url, timeout=self.timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._slots.clear()
+
+    def _links_from_doi(self, href: str) -> List[str]:
+        response = self.get(href)
+        response = self.get(response.url)
+        soup = BeautifulSoup(response.text, "lxml")
+        url = response.url
+        if any(publisher.match(url) for publisher in _CITATION_META_PUBLISHERS):
+            return [
+                meta["content"]
+                for meta in soup.find_all("meta", {"name": _CITATION_META_RE})
+            ]
+        if _NATURE_RE.match(url):
+            return [f"https://www.nature.com/articles/{url.split('/')[-1]}.pdf"]
+        if _BIOMEDCENTRAL_RE.match(url):
+            return [f"https://www.nature.com/articles/{url.split('/')[-2]}.pdf"]
+        return []
+
+    def resolve_links(self, url: str) -> List[str]:
+        """Links to the evidence files behind a CGSpace handle (or DOI) URL."""
+        if not is_url(url):
+            return []
+        if self.cache is not None:
+            links = self.cache.get_links(url)
+            if links is not None:
+                return links
+
+        links = self._resolve_links(url)
+        # Empty results are not stored: they are often transient failures.
+        if links and self.cache is not None:
+            self.cache.put_links(url, links)
+        return links
+
+    def _resolve_links(self, url: str) -> List[str]:
+        response = self.get(url)
+        if not self.handle_re.match(response.url):
+            print(f"Error: {response.url}. Unable to find a PDF file link.")
+            return []
+        if response.url in SKIPPED_HANDLES:
+            print(f"Error: Skipping {response.url}.")
+            return []
+
+        soup = BeautifulSoup(response.text, "lxml")
+        # if there are any pdfs on the page directly access them - https://cgspace.cgiar.org/handle/10568/126321; https://cgspace.cgiar.org/handle/10568/116411; https://cgspace.cgiar.org/handle/10568/121051
+        links = [a["href"] for a in soup.find_all("a", {"href": _PDF_HREF_RE})]
+        # files on Github - ex. https://hdl.handle.net/10568/127746
+        if not links:
+            links = [
+                meta["content"]
+                for meta in soup.find_all("meta", {"name": _CITATION_META_RE})
+            ]
+        if not links:
+            for a in soup.find_all("a", href=True):
+                href = a["href"]
+                if href.startswith("https://doi.org/"):
+                    links.extend(self._links_from_doi(href))
+                elif href.startswith("https://www.iwmi.cgiar.org/"):
+                    links.append(href)
+        return links
+
+    def get_url_content(self, url: str) -> Optional[str]:
+        """The notebooks' get_url_content: resolved links joined, or None."""
+        links = self.resolve_links(url)
+        return "".join(links) if links else None
+
+    def download(
+        self, url: str, path: str, validate=None, index: Optional[CorpusIndex] = None
+    ) -> Optional[dict]:
+        """Stream `url` to `path`; the file only appears once complete.
+
+        The body goes straight to a temporary file, hashed on the way, so memory
+        use does not grow with the file. `validate(tmp_path)` can reject the
+        download before it replaces `path`. Returns the size and sha256 of the
+        file, also recorded in `index` if given, or None on failure. A file the
+        cache knows is unchanged (304 or same sha256) is not rewritten.
+        """
+        cached = self.cache.get_download(url, path) if self.cache else None
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self._slot(url) as session:
+            with session.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            ) as response:
+                if response.status_code == 304 and cached is not None:
+                    return {"size": cached["size"], "sha256": cached["sha256"]}
+                if response.status_code != 200:
+                    print(f"Error: Unable to download {url} ({response.status_code})")
+                    return None
+                directory = os.path.dirname(path)
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+                try:
+                    digest = hashlib.sha256()
+                    size = 0
+                    with os.fdopen(fd, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                    if validate is not None and not validate(tmp_path):
+                        print(f"Error: {url} did not return a valid file")
+                        os.unlink(tmp_path)
+                        return None
+                    info = {"size": size, "sha256": digest.hexdigest()}
+                    if cached is not None and cached["sha256"] == info["sha256"]:
+                        # Same content without validators: leave the file (and
+                        # its mtime, which the corpus index keys on) untouched.
+                        os.unlink(tmp_path)
+                    else:
+                        os.replace(tmp_path, path)
+                        if index is not None:
+                            index.record_file(path, info["sha256"])
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                    raise
+
+                if self.cache is not None:
+                    self.cache.put_download(
+                        url,
+                        path,
+                        size,
+                        info["sha256"],
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                    )
+        return info
+
+    def download_result_pdf(
+        self,
+        root: str,
+        result_id,
+        phase: Optional[int] = None,
+        index: Optional[CorpusIndex] = None,
+    ) -> Optional[dict]:
+        """Download the PRMS report of `result_id` to `<root>/<result_id>/result.pdf`.
+
+        The report is saved as served, without re-parsing and rewriting it.
+        """
+        url = RESULT_PDF_URL.format(id=result_id)
+        if phase is not None:
+            url += f"?phase={phase}"
+        path = os.path.join(root, str(result_id), RESULT_FILENAME)
+        info = self.download(url, path, validate=looks_like_pdf, index=index)
+        if info is None:
+            print(f"Error: Unable to download result.pdf for Result ID {result_id}")
+        else:
+            print(f"Successfully downloaded result.pdf for Result ID {result_id}")
+        return info
+
+    def download_evidence(
+        self, root: str, result_id, links: Iterable[str], exclusion: Sequence[str] = ()
+    ) -> List[str]:
+        """Download the .pdf/.pptx `links` into `<root>/<result_id>/`."""
+        path = os.path.join(root, str(result_id))
+        os.makedirs(path, exist_ok=True)
+        paths = []
+        for link in links:
+            extension = get_extension(link)
+            if link in exclusion or extension not in EVIDENCE_EXTENSIONS:
+                continue
+            file_path = os.path.join(path, get_filename(link) + extension)
+            if self.download(link, file_path):
+                paths.append(file_path)
+        return paths
+
+    def resolve_all(
+        self, urls: Iterable[str], max_workers: int = 16
+    ) -> Iterator[Tuple[str, List[str], Optional[BaseException]]]:
+        """resolve_links for every URL; yields (url, links, error) as they finish."""
+        return run_concurrently(self.resolve_links, urls, max_workers=max_workers)
+
+    def download_result_pdfs(
+        self,
+        root: str,
+        result_ids: Iterable,
+        phase: Optional[int] = None,
+        max_workers: int = 16,
+    ) -> Dict[object, Optional[dict]]:
+        """Download many result.pdf files concurrently and record them in the
+        corpus manifest of `root`, so indexing does not hash them again."""
+        index = CorpusIndex(root)
+        index.load()
+        downloaded = {}
+        for result_id, info, error in run_concurrently(
+            lambda result_id: self.download_result_pdf(root, result_id, phase, index),
+            result_ids,
+            max_workers=max_workers,
+        ):
+            if error is not None:
+                print(f"Error: Unable to download result {result_id}: {error!r}")
+            downloaded[result_id] = info
+        index.save()
+        return downloaded
+
+    def download_all(
+        self,
+        root: str,
+        evidence: Iterable[Tuple[object, Sequence[str]]],
+        exclusion: Sequence[str] = (),
+        max_workers: int = 16,
+    ) -> Iterator[
+        Tuple[Tuple[object, Sequence[str]], List[str], Optional[BaseException]]
+    ]:
+        """Download the links of every (result_id, links) pair concurrently."""
+        return run_concurrently(
+            lambda item: self.download_evidence(root, item[0], item[1], exclusion),
+            evidence,
+            max_workers=max_workers,
+        )
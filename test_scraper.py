@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from scrape_cache import ScrapeCache
+from scraper import Scraper, looks_like_pdf
+
+PDF = b"%PDF-1.4\n" + b"0" * 3_000_000 + b"\n%%EOF\n"
+ETAG = '"v1"'
+SLOW_DELAY = 0.2
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+        if self.path == "/report.pdf":
+            if self.headers.get("If-None-Match") == ETAG:
+                self._send(304, b"")
+            else:
+                self._send(200, PDF, ETag=ETAG)
+        elif self.path == "/login.html":
+            self._send(200, b"<html>Please log in</html>")
+        elif self.path == "/slow":
+            with server.lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            time.sleep(SLOW_DELAY)
+            with server.lock:
+                server.active -= 1
+            self._send(200, b"done")
+        else:
+            self._send(404, b"")
+
+    def _send(self, status, body, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.active = server.max_active = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _leftovers(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".part")]
+
+
+def test_download_streams_to_path(server, tmp_path):
+    scraper = Scraper(user_agent="test")
+    path = str(tmp_path / "1" / "result.pdf")
+    info = scraper.download(f"{server.url}/report.pdf", path, validate=looks_like_pdf)
+
+    assert info["size"] == len(PDF)
+    with open(path, "rb") as f:
+        assert f.read() == PDF
+    assert _leftovers(tmp_path / "1") == []
+
+
+def test_download_rejected_by_validate_keeps_previous_file(server, tmp_path):
+    scraper = Scraper(user_agent="test")
+    path = str(tmp_path / "result.pdf")
+    with open(path, "wb") as f:
+        f.write(PDF)
+
+    info = scraper.download(f"{server.url}/login.html", path, validate=looks_like_pdf)
+
+    assert info is None
+    with open(path, "rb") as f:
+        assert f.read() == PDF
+    assert _leftovers(tmp_path) == []
+
+
+def test_download_not_modified(server, tmp_path):
+    cache = ScrapeCache(str(tmp_path / "scrape.sqlite"))
+    scraper = Scraper(user_agent="test", cache=cache)
+    url = f"{server.url}/report.pdf"
+    path = str(tmp_path / "result.pdf")
+    first = scraper.download(url, path, validate=looks_like_pdf)
+    mtime = os.stat(path).st_mtime_ns
+
+    second = scraper.download(url, path, validate=looks_like_pdf)
+
+    assert second == first
+    assert os.stat(path).st_mtime_ns == mtime
+    (_, first_headers), (_, second_headers) = server.requests
+    assert "If-None-Match" not in first_headers
+    assert second_headers["If-None-Match"] == ETAG
+
+
+def test_requests_per_host_are_capped(server):
+    scraper = Scraper(max_per_host=2, user_agent="test")
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        responses = list(executor.map(scraper.get, [f"{server.url}/slow"] * 6))
+
+    assert [response.text for response in responses] == ["done"] * 6
+    assert server.max_active == 2
@@ -1,16 +1,24 @@
-import json
-from typing import Any, Iterator, List
+import hashlib
+from typing import List
 
-import boto3
-from langchain.llms.bedrock import Bedrock, LLMInputOutputAdapter
-from langchain.schema.output import GenerationChunk
 from pydantic.v1 import BaseModel, Field
 
-session = boto3.Session(region_name="us-east-1")
-boto3_bedrock = boto3.client(service_name="bedrock", region_name="us-east-1")
-boto3_bedrock_stream = boto3.client(
-    service_name="bedrock-runtime", region_name="us-east-1"
-)
+# The LLM wrappers and AWS clients live in llms.py and are only imported on first
+# use, so loading the schemas does not pull in boto3 or the langchain LLM stack.
+_LLM_CLASSES = ("NewAzureChatOpenAI", "NewBedrock", "NewChatOpenAI")
+_AWS_CLIENT_FACTORIES = {
+    "session": "get_boto3_session",
+    "boto3_bedrock": "get_bedrock_client",
+    "boto3_bedrock_stream": "get_bedrock_runtime_client",
+}
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class Description(BaseModel):
@@ -198,57 +206,18 @@ class ImpactAreaTags(BaseModel):
     impact_justifications: ImpactJustifications
 
 
-class NewBedrock(Bedrock):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-    def _prepare_input_and_invoke_stream(
-        self, prompt, stop=None, run_manager=None, **kwargs
-    ) -> Iterator[GenerationChunk]:
-        _model_kwargs = {
-            "prompt": Any,
-            "max_tokens_to_sample": 8192,
-            "temperature": 0.0,
-        }
-        provider = "anthropic"
-        model_kwargs = {**_model_kwargs, **kwargs}
-        input_body = LLMInputOutputAdapter.prepare_input(provider, prompt, model_kwargs)
-        body = json.dumps(input_body)
-        try:
-            response = boto3_bedrock_stream.invoke_model(
-                body=body,
-                modelId="anthropic.claude-v2",
-                accept="application/json",
-                contentType="application/json",
-            )
-        except Exception as e:
-            raise ValueError(f"Error raised by bedrock service: {e}")
-
-        for chunk in LLMInputOutputAdapter.prepare_output_stream(
-            provider, response, stop
-        ):
-            yield chunk
-
-    def _prepare_input_and_invoke(self, prompt, stop=None, run_manager=None, **kwargs):
-        _model_kwargs = {
-            "prompt": Any,
-            "max_tokens_to_sample": 8192,
-            "temperature": 0.2,
-        }
-        provider = "anthropic"
-        model_kwargs = {**_model_kwargs, **kwargs}
-        input_body = LLMInputOutputAdapter.prepare_input(provider, prompt, model_kwargs)
-        body = json.dumps(input_body)
-        try:
-            response = boto3_bedrock_stream.invoke_model(
-                body=body,
-                modelId="anthropic.claude-v2",
-                accept="application/json",
-                contentType="application/json",
-            )
-            text = LLMInputOutputAdapter.prepare_output(provider, response)
-
-        except Exception as e:
-            raise ValueError(f"Error raised by bedrock service: {e}")
-
-        return text
+class ResultExtraction(BaseModel):
+    innovation_profile: InnovationProfile
+    project: ImpactAreas
+
+
+def __getattr__(name):
+    if name in _LLM_CLASSES:
+        import llms
+
+        return getattr(llms, name)
+    if name in _AWS_CLIENT_FACTORIES:
+        import llms
+
+        return getattr(llms, _AWS_CLIENT_FACTORIES[name])()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")